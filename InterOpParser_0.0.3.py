@@ -12,57 +12,773 @@
 ###
 ######################################################################################################
 
+### Only light standard library modules are imported up front. numpy, pandas, matplotlib and the
+### interop bindings are imported inside the stages that use them, so -h, argument errors and
+### --lanes_only runs do not pay for the ones they never touch.
+
 import sys
 import getopt
 import os
 import re
-import pandas as pd
 import collections
-import numpy as np
-import matplotlib.pyplot as plt
-from interop import py_interop_run_metrics
-from interop import py_interop_run
-from interop import py_interop_table
-from interop import py_interop_metrics
-from interop import py_interop_plot
-from interop import py_interop_comm
-from interop import py_interop_summary
+import concurrent.futures
+import datetime
+import json
+import hashlib
+import time
+import traceback
+
+
+USAGE = ('InterOpParser.py -s <StreamingPath> -t <FlowcellType> [-o <OutputPath>]\n'
+	 'InterOpParser.py -b <RunFolderDir|RunListFile> -t <FlowcellType> [-o <OutputPath>] [-w <Workers>]\n'
+	 'InterOpParser.py -f -s <StreamingPath> -t <FlowcellType> [-o <OutputPath>] [-i <IntervalSeconds>]\n'
+	 '  -c "<XColumn>,<YColumn>"  imaging table columns for the tile plot (default "% Occupied,% Pass Filter")\n'
+	 '  -C <CacheDir> [--cache_size <MB>]  reuse parses of unchanged run folders (single run and batch modes)\n'
+	 '  -p scatter|density|auto  tile plot rendering (default auto: hexbin density above 100000 points)\n'
+	 '  -l  additionally render one tile plot per lane\n'
+	 '  -D <QCStore.sqlite>  also record run, lane and tile metrics in a cross-run QC store\n'
+	 '  -r "<Read>,<Read>"  reads (1-based) to report lane and per-cycle metrics on (default: all non-index reads)\n'
+	 '  -q  also write by-cycle %Q30, error rate and intensity per lane and surface to PerCycleMetrics.json\n'
+	 '  --lanes_only | --plots_only  run only the lane/run metrics stage or only the tile plot stage\n'
+	 'InterOpParser.py -D <QCStore.sqlite> --query run|lane|tile [--instrument <Id>] [--flowcell_type <Type>]\n'
+	 '                 [--since <YYYY-MM-DD>] [--until <YYYY-MM-DD>]')
+
+
+PARSER_VERSION = "0.0.3"
+
+
+### Imaging table columns kept for the tile plot (x, y); rows are indexed by Lane/Tile/Cycle
+
+TILE_COLUMNS = ["% Occupied", "% Pass Filter"]
+TILE_INDEX = ["Lane", "Tile", "Cycle"]
+
+STAGES = ("lanes", "plots")
+
+### Lane summary columns: JSON label and py_interop_summary lane_summary accessor (also the QC store column name)
+
+LANE_COLUMNS = ( ('Lane', 'lane'), ('Density (K/mm2)', 'density'), ('ClustersPF', 'percent_pf'), ('Percent >= Q30', 'percent_gt_q30'), ('ErrorRate', 'error_rate'), \
+		 ('ErrorRate35Cycles', 'error_rate_35'), ('ErrorRate50Cycles', 'error_rate_50'), ('ErrorRate75Cycles', 'error_rate_75'), ('ErrorRate100Cycles', 'error_rate_100') )
+
+### Imaging table columns aggregated by cycle with -q; columns with per-channel children are expanded
+
+CYCLE_COLUMNS = ["%>= Q30", "Error Rate", "P90"]
+CYCLE_KEYS = ["Read", "Lane", "Cycle", "Cycle Within Read"]
+
+CACHE_SIZE = 2048						### MB; least recently used entries are evicted beyond this
+
+
+### Tile plot rendering: mode is scatter, density (hexbin) or auto; workers render the panels in parallel
+
+PlotOptions = collections.namedtuple('PlotOptions', ['mode', 'lane_panels', 'workers'])
+PLOT_OPTIONS = PlotOptions('auto', False, 1)
+DENSITY_THRESHOLD = 100000
+
+
+### InterOp file prefix (as in <Prefix>MetricsOut.bin, or <Prefix>Metrics_<cycle>_1.bin in the per-cycle folders)
+### to the py_interop_run metric group it populates
+
+INTEROP_FILE_METRICS = { 'Tile': 'Tile', 'ExtendedTile': 'ExtendedTile', 'Extraction': 'Extraction', 'Q': 'Q', 'Q2030': 'QCollapsed', \
+			 'QByLane': 'QByLane', 'Error': 'Error', 'CorrectedInt': 'CorrectedInt', 'Index': 'Index', 'Image': 'Image', \
+			 'EmpiricalPhasing': 'EmpiricalPhasing', 'DynamicPhasing': 'DynamicPhasing', 'SummaryRun': 'SummaryRun' }
+
+### Metric group to the name of its metric set in the interop bindings (run_metrics.<name>_metric_set,
+### py_interop_metrics.base_<name>_metrics); the phasing metrics have none
+
+METRIC_SETS = { 'Tile': 'tile', 'ExtendedTile': 'extended_tile', 'Extraction': 'extraction', 'Q': 'q', 'QCollapsed': 'q_collapsed', \
+		'QByLane': 'q_by_lane', 'Error': 'error', 'CorrectedInt': 'corrected_intensity', 'Index': 'index', 'Image': 'image', \
+		'SummaryRun': 'summary_run' }
+
+### Metric groups keyed by tile and cycle, whose files only grow while a run sequences. Tile, ExtendedTile,
+### Index and the phasing metrics are rewritten in place instead.
+
+APPEND_ONLY_METRICS = ('Extraction', 'Q', 'QCollapsed', 'QByLane', 'Error', 'CorrectedInt', 'Image')
 
 
 def main(argv):
 
 	if (len(argv) < 3):
-		print ('InterOpParser.py -s <StreamingPath> -t <FlowcellType>')
+		print (USAGE)
 		sys.exit(2)
 
 	StreamingPath = ''
 	FlowcellType = ''
+	BatchPath = ''
+	OutputPath = '.'
+	Workers = os.cpu_count()
+	Follow = False
+	Interval = 300
+	TileColumns = TILE_COLUMNS
+	CachePath = None
+	CacheSize = CACHE_SIZE
+	PlotMode = PLOT_OPTIONS.mode
+	LanePanels = PLOT_OPTIONS.lane_panels
+	DatabasePath = None
+	Query = None
+	Filters = {}
+	Reads = None
+	PerCycle = False
+	Stages = STAGES
 
 	try:
-		opts, args = getopt.getopt(argv, "hs:t:", ["streaming_path=", "type="]);
+		opts, args = getopt.getopt(argv, "hs:t:b:o:w:fi:c:C:p:lD:r:q", ["streaming_path=", "type=", "batch=", "output=", "workers=", "follow", "interval=", "columns=", \
+						"cache=", "cache_size=", "plot=", "lane_panels", "database=", "query=", "instrument=", "flowcell_type=", \
+						"since=", "until=", "reads=", "per_cycle", "lanes_only", "lanes-only", "plots_only", "plots-only"]);
 		
 	except getopt.GetoptError:
-		print ('InterOpParser.py -s <StreamingPath> -t <FlowcellType>')
+		print (USAGE)
 		sys.exit(2)
 		
 	for opt, arg in opts:
 		if opt == "-h":
-			print ('InterOpParser.py -s <StreamingPath> -t <FlowcellType>')
+			print (USAGE)
 			sys.exit()
 		elif opt in ("-s", "--streaming_path"):
 			StreamingPath = arg
 		elif opt in ("-t", "--type"):
 			FlowcellType = arg
+		elif opt in ("-b", "--batch"):
+			BatchPath = arg
+		elif opt in ("-o", "--output"):
+			OutputPath = arg
+		elif opt in ("-w", "--workers"):
+			Workers = int(arg)
+		elif opt in ("-f", "--follow"):
+			Follow = True
+		elif opt in ("-i", "--interval"):
+			Interval = float(arg)
+		elif opt in ("-c", "--columns"):
+			TileColumns = [column.strip() for column in arg.split(',')]
+			if len(TileColumns) != 2:
+				print (USAGE)
+				sys.exit(2)
+		elif opt in ("-C", "--cache"):
+			CachePath = arg
+		elif opt == "--cache_size":
+			CacheSize = float(arg)
+		elif opt in ("-p", "--plot"):
+			if arg not in ("scatter", "density", "auto"):
+				print (USAGE)
+				sys.exit(2)
+			PlotMode = arg
+		elif opt in ("-l", "--lane_panels"):
+			LanePanels = True
+		elif opt in ("-D", "--database"):
+			DatabasePath = arg
+		elif opt == "--query":
+			Query = arg
+		elif opt in ("--instrument", "--flowcell_type", "--since", "--until"):
+			Filters[opt[2:]] = arg
+		elif opt in ("-r", "--reads"):
+			Reads = [int(read) for read in arg.split(',')]
+		elif opt in ("-q", "--per_cycle"):
+			PerCycle = True
+		elif opt in ("--lanes_only", "--lanes-only"):
+			Stages = ("lanes",)
+		elif opt in ("--plots_only", "--plots-only"):
+			Stages = ("plots",)
+	
+	if Query:
+		if not DatabasePath or Query not in ("run", "lane", "tile"):
+			print (USAGE)
+			sys.exit(2)
+		print (query_QC_Store(DatabasePath, Query, **Filters).to_csv(index=False), end='')
+		return
+		
+	if BatchPath:
+		### Batch workers are already parallel across runs, so each run renders its panels serially
+		PlotOpts = PlotOptions(PlotMode, LanePanels, 1)
+		failed = run_Batch(BatchPath, FlowcellType, OutputPath, Workers, TileColumns, CachePath, CacheSize, PlotOpts, DatabasePath, \
+				   Reads, PerCycle, Stages)
+		if failed:
+			sys.exit(1)
+		return
 		
 	if not os.path.isdir(os.path.join(StreamingPath, 'InterOp')):
 		print ("InterOp directory not found within {} folder", StreamingPath)
 	
-	calculate_Lane_Metrics(StreamingPath)
+	PlotOpts = PlotOptions(PlotMode, LanePanels, Workers)
+	
+	if Follow:
+		watch_Run(StreamingPath, FlowcellType, OutputPath, Interval, TileColumns, PlotOpts, Reads, PerCycle, Stages)
+		return
+	
+	process_Run(StreamingPath, FlowcellType, OutputPath, TileColumns, CachePath, CacheSize, PlotOpts, DatabasePath, Reads, PerCycle, \
+		    Stages)
+	
+
+	
+def process_Run(StreamingPath, FlowcellType, OutputPath='.', TileColumns=TILE_COLUMNS, CachePath=None, CacheSize=CACHE_SIZE, \
+		PlotOpts=PLOT_OPTIONS, DatabasePath=None, Reads=None, PerCycle=False, Stages=STAGES):
+	
+	### Full parse of a single run folder: lane/run level metrics and the tile plot.
+	### With a CachePath, a run whose InterOp files are unchanged is served from the cache
+	### without reading the binary files again. With a DatabasePath the metrics are also
+	### recorded in the cross-run QC store. Stages selects the lane metrics and/or the tile plot;
+	### only the InterOp metrics the selected stages need are read.
+	
+	os.makedirs(OutputPath, exist_ok=True)
+	
+	cached = None
+	if CachePath:
+		key = cache_Key(StreamingPath, TileColumns, Reads, PerCycle, Stages)
+		cached = read_Cache(CachePath, key)
+		
+	if cached is None:
+		run_metrics = load_Run_Metrics(StreamingPath, Stages, PerCycle)
+		lane_jsons, yield_json, tile_df, cycle_json = [], '', None, ''
+		if "lanes" in Stages:
+			lane_jsons, yield_json = summarize_Lane_Metrics(run_metrics, Reads)
+		if "plots" in Stages:
+			tile_df = build_Tile_Table(run_metrics, TileColumns)
+		if PerCycle:
+			cycle_json = summarize_Cycle_Metrics(run_metrics, Reads)
+		del run_metrics
+		if CachePath:
+			write_Cache(CachePath, key, lane_jsons, yield_json, tile_df, CacheSize, cycle_json)
+	else:
+		lane_jsons, yield_json, tile_df, cycle_json = cached
+		
+	if "lanes" in Stages:
+		write_Lane_Metrics(OutputPath, lane_jsons, yield_json)
+	
+	if PerCycle:
+		write_Cycle_Metrics(OutputPath, cycle_json)
+	
+	if "plots" in Stages:
+		plot_Tile_Table(tile_df, StreamingPath, FlowcellType, OutputPath, PlotOpts)
+	
+	if DatabasePath:
+		store_QC_Metrics(DatabasePath, StreamingPath, FlowcellType, lane_jsons, yield_json, tile_df)
+	
+	
+
+def collect_Batch_Runs(BatchPath, FlowcellType):
+	
+	### A batch is either a directory of run folders, or a list file with one run per line:
+	###	<StreamingPath> [<FlowcellType>]
+	### Runs without a FlowcellType in the list file fall back to the -t value.
+	
+	runs = []
+	if os.path.isdir(BatchPath):
+		for entry in sorted(os.listdir(BatchPath)):
+			run_path = os.path.join(BatchPath, entry)
+			if os.path.isdir(os.path.join(run_path, 'InterOp')):
+				runs.append((run_path, FlowcellType))
+	else:
+		with open(BatchPath, 'r') as run_list:
+			for line in run_list:
+				fields = re.split(r'[\s,]+', line.strip())
+				if not fields[0] or fields[0].startswith('#'):
+					continue
+				runs.append((fields[0], fields[1] if len(fields) > 1 else FlowcellType))
+				
+	return runs
+	
+	
+
+def process_Batch_Run(StreamingPath, FlowcellType, OutputPath, TileColumns=TILE_COLUMNS, CachePath=None, CacheSize=CACHE_SIZE, \
+		PlotOpts=PLOT_OPTIONS, DatabasePath=None, Reads=None, PerCycle=False, Stages=STAGES):
+	
+	### Worker for run_Batch; never raises so that one bad run does not stop the batch
+	
+	try:
+		if not os.path.isdir(os.path.join(StreamingPath, 'InterOp')):
+			raise FileNotFoundError("InterOp directory not found within {} folder".format(StreamingPath))
+		
+		clear_Lane_Metrics(OutputPath)
+		process_Run(StreamingPath, FlowcellType, OutputPath, TileColumns, CachePath, CacheSize, PlotOpts, DatabasePath, Reads, PerCycle, \
+			    Stages)
+		return (StreamingPath, None)
+	except Exception:
+		return (StreamingPath, traceback.format_exc())
+		
+		
+
+def run_Batch(BatchPath, FlowcellType, OutputPath='.', Workers=None, TileColumns=TILE_COLUMNS, CachePath=None, CacheSize=CACHE_SIZE, \
+		PlotOpts=PLOT_OPTIONS, DatabasePath=None, Reads=None, PerCycle=False, Stages=STAGES):
+	
+	### Fan the run folders out over a process pool. Outputs of every run are written to
+	### <OutputPath>/<RunFolderName>/ and a BatchSummary.json reports the status of each run.
+	
+	runs = collect_Batch_Runs(BatchPath, FlowcellType)
+	if not runs:
+		print ("No run folders found in {}".format(BatchPath))
+		return []
+		
+	status = collections.OrderedDict()
+	failed = []
+	
+	with concurrent.futures.ProcessPoolExecutor(max_workers=Workers) as pool:
+		futures = {}
+		for run_path, run_type in runs:
+			run_name = os.path.basename(re.sub('/$', '', run_path))
+			futures[pool.submit(process_Batch_Run, run_path, run_type, os.path.join(OutputPath, run_name), TileColumns, \
+						CachePath, CacheSize, PlotOpts, DatabasePath, Reads, PerCycle, Stages)] = run_path
+			
+		for future in concurrent.futures.as_completed(futures):
+			run_path = futures[future]
+			try:
+				error = future.result()[1]
+			except Exception:
+				error = traceback.format_exc()
+				
+			if error is None:
+				status[run_path] = "OK"
+				print ("Processed {}".format(run_path))
+			else:
+				status[run_path] = error
+				failed.append(run_path)
+				print ("Failed {}:\n{}".format(run_path, error))
+				
+	print ("Batch complete: {} of {} runs processed, {} failed".format(len(runs) - len(failed), len(runs), len(failed)))
+	
+	os.makedirs(OutputPath, exist_ok=True)
+	with open(os.path.join(OutputPath, 'BatchSummary.json'), 'w') as b:
+		json.dump(status, b, indent=1)
+		
+	return failed
+	
+	
+
+def watch_Run(StreamingPath, FlowcellType, OutputPath='.', Interval=300, TileColumns=TILE_COLUMNS, PlotOpts=PLOT_OPTIONS, \
+		Reads=None, PerCycle=False, Stages=STAGES):
+	
+	### Follow a run that is still sequencing. Every Interval seconds the InterOp folder is re-scanned,
+	### the metric groups whose files changed are refreshed in the existing run_metrics object (see
+	### refresh_Run_Metrics for what is read incrementally), and the lane metrics and tile plot are
+	### re-emitted. Stops once the run is complete and the InterOp files have settled.
+	
+	os.makedirs(OutputPath, exist_ok=True)
+	
+	run_metrics = None
+	fingerprints = {}
+	while True:
+		current = fingerprint_InterOp(StreamingPath)
+		complete = is_Run_Complete(StreamingPath)
+		changed = []
+		
+		try:
+			if run_metrics is None:
+				run_metrics = load_Run_Metrics(StreamingPath, Stages, PerCycle)
+				changed = ["all"]
+			else:
+				changed = changed_Metric_Types(fingerprints, current)
+				if changed:
+					refresh_Run_Metrics(StreamingPath, run_metrics, changed, fingerprints, current, Stages, PerCycle)
+					
+			if changed:
+				if "lanes" in Stages:
+					clear_Lane_Metrics(OutputPath)
+					calculate_Lane_Metrics(StreamingPath, run_metrics, OutputPath, Reads)
+				if PerCycle:
+					write_Cycle_Metrics(OutputPath, summarize_Cycle_Metrics(run_metrics, Reads))
+				if "plots" in Stages:
+					generate_Tile_Plots(StreamingPath, FlowcellType, run_metrics, OutputPath, TileColumns, PlotOpts)
+				print ("{}: refreshed {} metrics".format(time.strftime('%Y-%m-%d %H:%M:%S'), ", ".join(changed)))
+			fingerprints = current
+		except Exception:
+			### Early in a run some metrics are not written yet; keep following rather than give up
+			print ("Refresh of {} failed, retrying in {} seconds:\n{}".format(StreamingPath, Interval, traceback.format_exc()))
+			
+		if complete and run_metrics is not None and not changed:
+			print ("Run {} complete".format(StreamingPath))
+			return run_metrics
+			
+		time.sleep(Interval)
+		
+		
+
+def is_Run_Complete(StreamingPath):
+	
+	return any(os.path.exists(os.path.join(StreamingPath, marker)) for marker in ('CopyComplete.txt', 'RTAComplete.txt'))
+	
+	
+
+def fingerprint_InterOp(StreamingPath):
+	
+	### (size, mtime) of every binary file under <run>/InterOp, including the per-cycle C<N>.1 folders
+	
+	fingerprints = {}
+	interop_path = os.path.join(StreamingPath, 'InterOp')
+	for root, dirs, files in os.walk(interop_path):
+		for name in files:
+			if name.endswith('.bin'):
+				path = os.path.join(root, name)
+				stat = os.stat(path)
+				fingerprints[os.path.relpath(path, interop_path)] = (stat.st_size, stat.st_mtime_ns)
+				
+	return fingerprints
+	
+	
+
+def changed_Metric_Types(previous, current):
+	
+	### InterOp files added, removed or rewritten since the previous scan, by the metric group they hold
+	
+	changed = collections.defaultdict(list)
+	for path in set(previous) ^ set(current) | {p for p in current if p in previous and previous[p] != current[p]}:
+		metric = interop_File_Metric(path)
+		if metric:
+			changed[metric].append(path)
+			
+	return collections.OrderedDict((metric, sorted(changed[metric])) for metric in sorted(changed))
+	
+	
+
+def interop_File_Metric(path):
+	
+	m = re.match(r'(\w+?)Metrics(\w*?)(Out)?(_\d+_\d+)?\.bin$', os.path.basename(path))
+	if m and m.group(1) + m.group(2) in INTEROP_FILE_METRICS:
+		return INTEROP_FILE_METRICS[m.group(1) + m.group(2)]
+	return None
+	
+	
+
+def refresh_Run_Metrics(StreamingPath, run_metrics, changed, previous, current, Stages=STAGES, PerCycle=False):
+	
+	### Bring the changed metric groups that run_metrics was loaded with up to date. The interop library
+	### clears a metric set before reading into it and cannot read a file from an offset, so for the
+	### APPEND_ONLY_METRICS only the records added since the previous scan (the grown tail of a
+	### <Prefix>MetricsOut.bin, or a new per-cycle C<N>.1 file where there is no MetricsOut.bin) are parsed
+	### and inserted into the loaded set. The groups rewritten in place, and files that shrank, were
+	### replaced or grew by part of a record, are re-read in full; read_metrics skips a metric set that is
+	### not empty, so the set is cleared first (the phasing metrics have no set to clear and are only read
+	### while empty). finalize_after_load has no incremental form, so the derived Q metrics and cumulative
+	### Q distributions are still rebuilt over the whole run.
+	
+	from interop import py_interop_run
+	from interop import py_interop_metrics
+	from interop import py_interop_run_metrics
+	
+	loaded = metrics_To_Load(Stages, PerCycle)
+	valid_to_load = py_interop_run.uchar_vector(py_interop_run.MetricCount, 0)
+	reread = False
+	top_level = {interop_File_Metric(path) for path in current if os.sep not in path}
+	for metric, paths in changed.items():
+		if not loaded[getattr(py_interop_run, metric)]:
+			continue
+		if metric in APPEND_ONLY_METRICS:
+			if metric in top_level:
+				appended = [(path, previous[path][0]) for path in paths if os.sep not in path and path in previous \
+					    and current.get(path, (0,))[0] > previous[path][0]]
+				incremental = len(appended) == len([path for path in paths if os.sep not in path])
+			else:
+				appended = [(path, 0) for path in paths if path not in previous]
+				incremental = len(appended) == len(paths)
+			name = METRIC_SETS[metric]
+			parsed = [read_Appended_Records(os.path.join(StreamingPath, 'InterOp', path), offset, current[path][0], \
+							getattr(py_interop_metrics, 'base_' + name + '_metrics')) for path, offset in appended] if incremental else [None]
+			if all(records is not None for records in parsed):
+				metric_set = getattr(run_metrics, name + '_metric_set')()
+				for records in parsed:
+					### Loaded sets have no id lookup; it is only needed when the new records may overlap them
+					if records.size() and not metric_set.empty() and records.at(0).cycle() <= metric_set.max_cycle():
+						metric_set.rebuild_index(True)
+					### The Q histograms of a loaded run are compressed to its Q score bins
+					compress = metric == 'Q' and py_interop_run_metrics.is_compressed(metric_set) and not py_interop_run_metrics.is_compressed(records)
+					for i in range(records.size()):
+						record = records.at(i)
+						if not metric_set.has_metric(record.id()):
+							if compress:
+								record.compress(metric_set)
+							metric_set.insert(record)
+				continue
+		valid_to_load[getattr(py_interop_run, metric)] = 1
+		reread = True
+		if metric in METRIC_SETS:
+			getattr(run_metrics, METRIC_SETS[metric] + '_metric_set')().clear()
+		
+	if reread:
+		run_metrics.read_metrics(StreamingPath, run_metrics.run_info().total_cycles(), valid_to_load, 1)
+		
+	### Collapsed and by-lane Q metrics without files of their own are derived from the Q metrics when
+	### the run is finalized, but only into empty sets
+	if 'Q' in changed and loaded[py_interop_run.Q]:
+		for metric in ('QCollapsed', 'QByLane'):
+			if not any(interop_File_Metric(path) == metric for path in current):
+				getattr(run_metrics, METRIC_SETS[metric] + '_metric_set')().clear()
+	run_metrics.finalize_after_load()
+	
+	
+
+def read_Appended_Records(path, offset, size, metric_class):
+	
+	### The records between byte offset and size of an InterOp file (offset 0 reads the whole file) as a
+	### new metric_class set, or None unless the bytes parse as whole records. There is no accessor for
+	### the header length of a format, so it is taken as the shortest prefix, as long as the file modulo
+	### its record size, that parses with exactly one record behind it.
+	
+	import numpy as np
+	from interop import py_interop_comm
+	
+	def parse(buffer):
+		records = metric_class()
+		try:
+			py_interop_comm.read_interop_from_buffer(np.frombuffer(bytearray(buffer), dtype=np.uint8), records)
+		except Exception:
+			return None
+		return records
+		
+	with open(path, 'rb') as f:
+		if not offset:
+			return parse(f.read(size))
+			
+		head = f.read(min(offset, 1 << 16))
+		record_size = head[1] if len(head) > 1 else 0
+		if not record_size or (size - offset) % record_size:
+			return None
+		for length in range(offset % record_size, len(head) - record_size + 1, record_size):
+			probe = parse(head[:length + record_size]) if length >= 2 else None
+			if probe is not None and probe.size() == 1:
+				f.seek(offset)
+				return parse(head[:length] + f.read(size - offset))
+				
+	return None
+	
+	
+
+def clear_Lane_Metrics(OutputPath):
+	
+	### RunCompletion.json is appended to per read, so start each parse of a run from a clean file
+	
+	stale = os.path.join(OutputPath, 'RunCompletion.json')
+	if os.path.exists(stale):
+		os.remove(stale)
+		
+		
+
+def cache_Key(StreamingPath, TileColumns=TILE_COLUMNS, Reads=None, PerCycle=False, Stages=STAGES):
+	
+	### Key of a parse: parser version and options, and size/mtime/content hash of every file
+	### the interop library reads (InterOp/*, RunInfo.xml, RunParameters.xml)
+	
+	key = hashlib.sha1()
+	key.update(PARSER_VERSION.encode())
+	key.update(",".join(TileColumns).encode())
+	key.update("reads={};per_cycle={};stages={}".format(Reads, PerCycle, ",".join(Stages)).encode())
+	
+	files = [os.path.join('InterOp', path) for path in fingerprint_InterOp(StreamingPath)] + ['RunInfo.xml', 'RunParameters.xml']
+	for path in sorted(files):
+		full_path = os.path.join(StreamingPath, path)
+		if not os.path.exists(full_path):
+			continue
+		stat = os.stat(full_path)
+		key.update("{}:{}:{}:".format(path, stat.st_size, stat.st_mtime_ns).encode())
+		with open(full_path, 'rb') as f:
+			for block in iter(lambda: f.read(1 << 20), b''):
+				key.update(block)
+				
+	return key.hexdigest()
+	
+	
+
+def read_Cache(CachePath, key):
+	
+	### (lane_jsons, yield_json, tile_df, cycle_json) for a cached parse, or None on a miss
+	
+	import numpy as np
+	import pandas as pd
+	
+	entry = os.path.join(CachePath, key + '.npz')
+	try:
+		with np.load(entry, allow_pickle=False) as cached:
+			tile_df = None
+			if 'tile_values' in cached:
+				index_names = [str(name) for name in cached['index_names']]
+				index = pd.MultiIndex.from_arrays([cached['index_' + name] for name in index_names], names=index_names)
+				tile_df = pd.DataFrame(cached['tile_values'], index=index, columns=[str(column) for column in cached['tile_columns']])
+			lane_jsons = [str(lane_json) for lane_json in cached['lane_jsons']]
+			yield_json = str(cached['yield_json'])
+			cycle_json = str(cached['cycle_json'])
+	except Exception:					### Missing or unreadable entry is a miss
+		return None
+		
+	os.utime(entry)						### Touch on hit; eviction goes by mtime
+	return lane_jsons, yield_json, tile_df, cycle_json
+	
+	
+
+def write_Cache(CachePath, key, lane_jsons, yield_json, tile_df, CacheSize=CACHE_SIZE, cycle_json=''):
+	
+	### Entries are written to a temporary file and renamed into place, so concurrent batch
+	### workers sharing a cache directory never see a partial entry
+	
+	import numpy as np
+	
+	os.makedirs(CachePath, exist_ok=True)
+	arrays = { 'lane_jsons': np.array(lane_jsons, dtype=str), 'yield_json': np.array(yield_json), 'cycle_json': np.array(cycle_json) }
+	if tile_df is not None:
+		index_names = list(tile_df.index.names)
+		arrays.update({ 'tile_values': tile_df.values, 'tile_columns': np.array(list(tile_df.columns)), 'index_names': np.array(index_names) })
+		for name in index_names:
+			arrays['index_' + name] = tile_df.index.get_level_values(name).values
+		
+	tmp = os.path.join(CachePath, '.{}.{}.npz'.format(key, os.getpid()))
+	np.savez(tmp, **arrays)
+	os.replace(tmp, os.path.join(CachePath, key + '.npz'))
+	
+	evict_Cache(CachePath, CacheSize)
+	
+	
+
+def evict_Cache(CachePath, CacheSize=CACHE_SIZE):
+	
+	### Remove least recently used entries until the cache fits in CacheSize MB
+	
+	entries = []
+	for name in os.listdir(CachePath):
+		if name.endswith('.npz') and not name.startswith('.'):
+			try:
+				stat = os.stat(os.path.join(CachePath, name))
+			except FileNotFoundError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, name))
+			
+	total = sum(entry[1] for entry in entries)
+	for mtime, size, name in sorted(entries):
+		if total <= CacheSize * 1024 * 1024:
+			break
+		try:
+			os.remove(os.path.join(CachePath, name))
+		except FileNotFoundError:
+			pass
+		total -= size
+		
+		
+
+def read_Run_Info(StreamingPath):
+	
+	### Run id, instrument, flowcell id and run date (YYYY-MM-DD) from RunInfo.xml
+	
+	from xml.etree import ElementTree
+	
+	info = { 'run_id': os.path.basename(re.sub('/$', '', StreamingPath)), 'instrument': None, 'flowcell_id': None, 'run_date': None }
+	try:
+		run = ElementTree.parse(os.path.join(StreamingPath, 'RunInfo.xml')).getroot().find('Run')
+	except (OSError, ElementTree.ParseError):
+		return info
+		
+	if run is None:
+		return info
+	info['run_id'] = run.get('Id', info['run_id'])
+	info['instrument'] = run.findtext('Instrument')
+	info['flowcell_id'] = run.findtext('Flowcell')
+	
+	date = (run.findtext('Date') or '').strip()
+	try:
+		info['run_date'] = datetime.date.fromisoformat(date[:10]).isoformat()
+	except ValueError:
+		for fmt in ('%y%m%d', '%m/%d/%Y %I:%M:%S %p', '%Y%m%d'):
+			try:
+				info['run_date'] = datetime.datetime.strptime(date, fmt).date().isoformat()
+				break
+			except ValueError:
+				pass
+				
+	return info
+	
+	
+
+def open_QC_Store(DatabasePath):
+	
+	### SQLite QC store: one row per run, per (run, read, lane) and per (run, lane, tile, metric).
+	### Tile metrics are averaged over cycles. Runs are indexed for instrument/flowcell type/date queries.
+	
+	import sqlite3
+	
+	db = sqlite3.connect(DatabasePath, timeout=600)
+	db.execute('PRAGMA journal_mode=WAL')
+	lane_columns = ", ".join("{} REAL".format(func) for label, func in LANE_COLUMNS if func != 'lane')
+	db.executescript('''
+		CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, instrument TEXT, flowcell_id TEXT, flowcell_type TEXT,
+						 run_date TEXT, streaming_path TEXT, parser_version TEXT, loaded_at TEXT,
+						 yield_nonindex_g REAL, yield_total_g REAL);
+		CREATE TABLE IF NOT EXISTS lanes (run_id TEXT, read INTEGER, lane INTEGER, {},
+						  PRIMARY KEY (run_id, read, lane));
+		CREATE TABLE IF NOT EXISTS tiles (run_id TEXT, lane INTEGER, tile INTEGER, metric TEXT, value REAL,
+						  PRIMARY KEY (run_id, lane, tile, metric));
+		CREATE INDEX IF NOT EXISTS runs_instrument ON runs (instrument, run_date);
+		CREATE INDEX IF NOT EXISTS runs_flowcell_type ON runs (flowcell_type, run_date);
+		CREATE INDEX IF NOT EXISTS runs_date ON runs (run_date);
+	'''.format(lane_columns))
+	
+	return db
+	
+	
+
+def store_QC_Metrics(DatabasePath, StreamingPath, FlowcellType, lane_jsons, yield_json, tile_df):
 	
-	generate_Tile_Plots(StreamingPath, FlowcellType)
+	### Replace what this parse produced for the run in a single transaction, so concurrent batch
+	### workers and re-parses of the same run never leave a partially written run behind.
+	### A --lanes_only or --plots_only parse keeps the tile or lane rows of an earlier parse.
 	
+	info = read_Run_Info(StreamingPath)
+	run_id = info['run_id']
+	yields = json.loads(yield_json) if yield_json else {}
+	
+	lane_rows = []
+	for lane_json in lane_jsons:
+		for record in json.loads(lane_json):
+			lane_rows.append([run_id, record['Read']] + [record[label] for label, func in LANE_COLUMNS])
+			
+	tile_rows = []
+	if tile_df is not None:
+		tile_means = tile_df.groupby(level=['Lane', 'Tile']).mean().stack()
+		tile_rows = [(run_id, int(lane), int(tile), metric, float(value)) for (lane, tile, metric), value in tile_means.items()]
+		
+	db = open_QC_Store(DatabasePath)
+	try:
+		with db:
+			db.execute('BEGIN IMMEDIATE')
+			db.execute('''INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+				      ON CONFLICT (run_id) DO UPDATE SET instrument = excluded.instrument, flowcell_id = excluded.flowcell_id,
+					flowcell_type = excluded.flowcell_type, run_date = excluded.run_date, streaming_path = excluded.streaming_path,
+					parser_version = excluded.parser_version, loaded_at = excluded.loaded_at,
+					yield_nonindex_g = COALESCE(excluded.yield_nonindex_g, yield_nonindex_g),
+					yield_total_g = COALESCE(excluded.yield_total_g, yield_total_g)''', \
+				   (run_id, info['instrument'], info['flowcell_id'], FlowcellType, info['run_date'], os.path.abspath(StreamingPath), \
+				    PARSER_VERSION, datetime.datetime.now().isoformat(timespec='seconds'), \
+				    yields.get('Non-Indexed Total', {}).get('Yield Total (G)'), yields.get('Total', {}).get('Yield Total (G)')))
+			if lane_jsons:
+				db.execute('DELETE FROM lanes WHERE run_id = ?', (run_id,))
+			if tile_df is not None:
+				db.execute('DELETE FROM tiles WHERE run_id = ?', (run_id,))
+			db.executemany('INSERT INTO lanes (run_id, read, {}) VALUES ({})'.format(", ".join(func for label, func in LANE_COLUMNS), \
+				       ", ".join("?" * (len(LANE_COLUMNS) + 2))), lane_rows)
+			db.executemany('INSERT INTO tiles VALUES (?, ?, ?, ?, ?)', tile_rows)
+	finally:
+		db.close()
+		
+		
 
+def query_QC_Store(DatabasePath, level='lane', instrument=None, flowcell_type=None, since=None, until=None):
+	
+	### Run, lane or tile metrics joined with their run attributes, filtered by instrument,
+	### flowcell type and run date range (inclusive, YYYY-MM-DD)
+	
+	import pandas as pd
 	
+	conditions = []
+	params = []
+	for column, op, value in (('instrument', '=', instrument), ('flowcell_type', '=', flowcell_type), \
+				  ('run_date', '>=', since), ('run_date', '<=', until)):
+		if value is not None:
+			conditions.append('runs.{} {} ?'.format(column, op))
+			params.append(value)
+			
+	query = 'SELECT runs.*' if level == 'run' else 'SELECT runs.instrument, runs.flowcell_type, runs.run_date, {}.*'.format(level + 's')
+	query += ' FROM runs' if level == 'run' else ' FROM runs JOIN {0} ON {0}.run_id = runs.run_id'.format(level + 's')
+	if conditions:
+		query += ' WHERE ' + ' AND '.join(conditions)
+	query += ' ORDER BY runs.run_date, runs.run_id'
+	
+	db = open_QC_Store(DatabasePath)
+	try:
+		return pd.read_sql_query(query, db, params=params)
+	finally:
+		db.close()
+		
+		
 
 def format_value(val):
 
@@ -73,34 +789,90 @@ def format_value(val):
 	
 	
 	
-def calculate_Lane_Metrics(StreamingPath):
+def metrics_To_Load(Stages=STAGES, PerCycle=False):
 	
-	### Capture specific metrics from the Interop binary files
+	### The summary metrics for the lane stage, the Tile/ExtendedTile/Extraction metrics for the plots,
+	### and the Q/Error metrics behind the per-cycle table
+	
+	from interop import py_interop_run
+	from interop import py_interop_run_metrics
 	
-	run_metrics = py_interop_run_metrics.run_metrics()
 	valid_to_load = py_interop_run.uchar_vector(py_interop_run.MetricCount, 0)
-	py_interop_run_metrics.list_summary_metrics_to_load(valid_to_load)
-	run_metrics.read(StreamingPath, valid_to_load)
+	if "lanes" in Stages:
+		py_interop_run_metrics.list_summary_metrics_to_load(valid_to_load)
+	if "plots" in Stages:
+		valid_to_load[py_interop_run.ExtendedTile] = 1
+		valid_to_load[py_interop_run.Tile] = 1
+		valid_to_load[py_interop_run.Extraction] = 1
+	if PerCycle:
+		valid_to_load[py_interop_run.Q] = 1
+		valid_to_load[py_interop_run.Error] = 1
+		valid_to_load[py_interop_run.Tile] = 1
+	
+	return valid_to_load
+	
+	
+	
+def load_Run_Metrics(StreamingPath, Stages=STAGES, PerCycle=False):
+	
+	### Read the InterOp binary files once, for both the lane summary and the tile plots.
+	### All metrics from metrics_To_Load() go into a single run_metrics object that is
+	### shared by the downstream stages.
+	
+	from interop import py_interop_run_metrics
+	
+	run_metrics = py_interop_run_metrics.run_metrics()
+	run_metrics.read(StreamingPath, metrics_To_Load(Stages, PerCycle))
+	
+	return run_metrics
+	
+	
+	
+def calculate_Lane_Metrics(StreamingPath, run_metrics=None, OutputPath='.', Reads=None):
+	
+	if run_metrics is None:
+		run_metrics = load_Run_Metrics(StreamingPath)
+		
+	lane_jsons, yield_json = summarize_Lane_Metrics(run_metrics, Reads)
+	write_Lane_Metrics(OutputPath, lane_jsons, yield_json)
+	
+	
+	
+def select_Reads(run_metrics, Reads=None):
+	
+	### 1-based read numbers to report on; by default every non-index read of the run
+	
+	if Reads:
+		return list(Reads)
+		
+	reads = run_metrics.run_info().reads()
+	return [reads[i].number() for i in range(reads.size()) if not reads[i].is_index()]
+	
+	
+	
+def summarize_Lane_Metrics(run_metrics, Reads=None):
+	
+	### Capture specific metrics from the Interop binary files
+	### Returns the per-read lane JSON records and the run level yield JSON
+	
+	import pandas as pd
+	from interop import py_interop_summary
+	
 	summary = py_interop_summary.run_summary()
 	py_interop_summary.summarize_run_metrics(run_metrics, summary)
-	columns = ( ('Lane', 'lane'), ('Density (K/mm2)', 'density'), ('ClustersPF', 'percent_pf'), ('Percent >= Q30', 'percent_gt_q30'), ('ErrorRate', 'error_rate'), \
-	            ('ErrorRate35Cycles', 'error_rate_35'), ('ErrorRate50Cycles', 'error_rate_50'), ('ErrorRate75Cycles', 'error_rate_75'), ('ErrorRate100Cycles', 'error_rate_100') )  
-		    
-		    	
-	reads = [0,3]					### Report the lane metrics on the non-index reads for the NovaSeqs in this version of the parser.
+	
+	lane_jsons = []
+	reads = [read - 1 for read in select_Reads(run_metrics, Reads)]
 	for read in reads:
 		rows = [summary.at(read).at(lane) for lane in range(summary.lane_count())]
 		d = []
 		d.append(("Read", read+1))
 		
-		for label, func in columns:
+		for label, func in LANE_COLUMNS:
 			d.append( (label, pd.Series([format_value(getattr(r, func)()) for r in rows])) )
 		
 		lane_df = pd.DataFrame.from_dict(collections.OrderedDict(d))
-		lane_json = lane_df.to_json(orient='records')
-		with open('RunCompletion.json', 'a+') as f:
-			f.write(lane_json)
-			f.write("\n")
+		lane_jsons.append(lane_df.to_json(orient='records'))
 			
 	
 	### Run level metrics only
@@ -111,24 +883,72 @@ def calculate_Lane_Metrics(StreamingPath):
 	run_d.append( ('Yield Total (G)', pd.Series([getattr(r[1], "yield_g")() for r in run_rows], index=[r[0] for r in run_rows])))
 	run_df = pd.DataFrame.from_dict(collections.OrderedDict(run_d))
 	yield_json = run_df.to_json(orient='index')
-		
-	with open('Yield.json', 'w') as y:		### Rewrite this to report within the RunCompleteion.json
+	
+	return lane_jsons, yield_json
+	
+	
+	
+def write_Lane_Metrics(OutputPath, lane_jsons, yield_json):
+	
+	for lane_json in lane_jsons:
+		with open(os.path.join(OutputPath, 'RunCompletion.json'), 'a+') as f:
+			f.write(lane_json)
+			f.write("\n")
+			
+	with open(os.path.join(OutputPath, 'Yield.json'), 'w') as y:		### Rewrite this to report within the RunCompleteion.json
 		y.write(yield_json)
+	
+	
+	
+	
+def summarize_Cycle_Metrics(run_metrics, Reads=None):
+	
+	### By-cycle means over tiles of the CYCLE_COLUMNS, per lane (Surface "All") and per lane and surface.
+	### The imaging table already holds the Q and Error metrics as one row per lane/tile/cycle, so the
+	### aggregation is a vectorized group-by over those arrays. Returns JSON records.
+	
+	import pandas as pd
+	
+	cycle_df = build_Imaging_Table(run_metrics, CYCLE_KEYS + ["Surface"] + CYCLE_COLUMNS, Index=[])
+	cycle_df = cycle_df[cycle_df["Read"].isin(select_Reads(run_metrics, Reads))]
+	
+	by_lane = cycle_df.drop(columns="Surface").groupby(CYCLE_KEYS).mean().reset_index()
+	by_lane.insert(2, "Surface", "All")
+	by_surface = cycle_df.groupby(CYCLE_KEYS[:2] + ["Surface"] + CYCLE_KEYS[2:]).mean().reset_index()
+	by_surface["Surface"] = by_surface["Surface"].astype(int).astype(str)
+	
+	cycle_df = pd.concat([by_lane, by_surface], ignore_index=True)
+	for key in CYCLE_KEYS:
+		cycle_df[key] = cycle_df[key].astype(int)
 		
-	#return lane_df.values.tolist()
+	return cycle_df.sort_values(CYCLE_KEYS[:3] + ["Surface"]).to_json(orient='records')
 	
 	
 	
+def write_Cycle_Metrics(OutputPath, cycle_json):
 	
-def generate_Tile_Plots(StreamingPath, FlowcellType):
-
-	valid_to_load = py_interop_run.uchar_vector(py_interop_run.MetricCount, 0)
-	valid_to_load[py_interop_run.ExtendedTile] = 1
-	valid_to_load[py_interop_run.Tile] = 1
-	valid_to_load[py_interop_run.Extraction] = 1
+	with open(os.path.join(OutputPath, 'PerCycleMetrics.json'), 'w') as c:
+		c.write(cycle_json)
+		
+		
+		
+def build_Tile_Table(run_metrics, TileColumns=TILE_COLUMNS):
+	
+	return build_Imaging_Table(run_metrics, TileColumns, TILE_INDEX)
+	
+	
+	
+def build_Imaging_Table(run_metrics, Columns, Index=TILE_INDEX):
+	
+	### Imaging table reduced to the requested columns, indexed by the Index columns (Lane, Tile, Cycle
+	### for the tile plot). A column with per-channel children, e.g. "P90", expands to all of them.
+	### The interop bindings only fill the full float32 table, so the requested columns are
+	### gathered into a compact array straight away and the full table is released.
+	
+	import numpy as np
+	import pandas as pd
+	from interop import py_interop_table
 	
-	run_metrics = py_interop_run_metrics.run_metrics()
-	run_metrics.read(StreamingPath, valid_to_load)
 	columns = py_interop_table.imaging_column_vector()
 	py_interop_table.create_imaging_table_columns(run_metrics, columns)
 	
@@ -140,6 +960,15 @@ def generate_Tile_Plots(StreamingPath, FlowcellType):
 			headers.extend([column.name()+"("+subname+")" for subname in column.subcolumns()])
 		else:
 			headers.append(column.name())
+			
+	### Column names are matched ignoring whitespace, which the bindings do not space consistently ("%>= Q30")
+	selected = []
+	for name in Columns:
+		squeezed = "".join(name.split())
+		matches = [header for header in headers if "".join(header.split()) == squeezed or "".join(header.split()).startswith(squeezed + "(")]
+		if not matches:
+			raise ValueError("Column {} not in the imaging table; available columns: {}".format(name, headers))
+		selected.extend(matches)
 	
 	column_count = py_interop_table.count_table_columns(columns)
 	row_offsets = py_interop_table.map_id_offset()
@@ -148,31 +977,92 @@ def generate_Tile_Plots(StreamingPath, FlowcellType):
 	data = np.zeros((row_offsets.size(), column_count), dtype=np.float32)
 	py_interop_table.populate_imaging_table_data(run_metrics, columns, row_offsets, data.ravel())
 	
-	header_subset = ["Lane", "% Occupied", "% Pass Filter"]
-	header_index = [(header, headers.index(header)) for header in header_subset]
-	ids = np.asarray([headers.index(header) for header in header_subset[:3]])
+	index_names = [header for header in Index if header in headers]
+	index = None
+	if index_names:
+		index = pd.MultiIndex.from_arrays([data[:, headers.index(header)].astype(np.int32) for header in index_names], names=index_names)
+	values = data[:, [headers.index(header) for header in selected]]
+	del data
+	
+	return pd.DataFrame(values, index=index, columns=selected)
 	
-	d = []
-	for label, col in header_index:
-		d.append( (label, pd.Series([val for val in data[:, col]], index=[tuple(r) for r in data[:, ids]])))
 	
-	tile_df = pd.DataFrame.from_dict(dict(d))
 	
+def generate_Tile_Plots(StreamingPath, FlowcellType, run_metrics=None, OutputPath='.', TileColumns=TILE_COLUMNS, PlotOpts=PLOT_OPTIONS):
+
+	if run_metrics is None:
+		run_metrics = load_Run_Metrics(StreamingPath)
+	
+	tile_df = build_Tile_Table(run_metrics, TileColumns)
+	plot_Tile_Table(tile_df, StreamingPath, FlowcellType, OutputPath, PlotOpts)
 	
-	#### Plotting code
-	#ymin = (int((tile_df["% Pass Filter"].min()))%10) * 10
-	ymin = (int((tile_df["% Pass Filter"].min())/10)) * 10 - 10
-	#xmin = (int((tile_df["% Occupied"].min()))%10) * 10
-	xmin = (int((tile_df["% Occupied"].min())/10)) * 10 - 10
-	plt.scatter(tile_df["% Occupied"], tile_df["% Pass Filter"])
-	plt.yticks(np.arange(ymin, 101, 10))
-	plt.xticks(np.arange(xmin, 101, 10))
-	plt.xlabel('% Occupied')
-	plt.ylabel('% Pass Filter')
+	
+	
+def plot_Tile_Table(tile_df, StreamingPath, FlowcellType, OutputPath='.', PlotOpts=PLOT_OPTIONS):
+	
+	### Plot of the first tile column against the second for the whole run, plus one panel per lane
+	### with PlotOpts.lane_panels. Panels are independent figures, rendered in PlotOpts.workers processes.
+	
+	import numpy as np
+	
+	xcol, ycol = tile_df.columns[0], tile_df.columns[1]
+	x = tile_df[xcol].values
+	y = tile_df[ycol].values
 	
 	StreamingPath = re.sub('/$', '', StreamingPath)
+	run_name = os.path.basename(StreamingPath)
+	prefix = os.path.join(OutputPath, run_name + "_" + FlowcellType)
+	
+	def density(points):
+		return PlotOpts.mode == 'density' or (PlotOpts.mode == 'auto' and points > DENSITY_THRESHOLD)
+		
+	panels = [(x, y, xcol, ycol, run_name, prefix + '.png', density(len(x)))]
+	if PlotOpts.lane_panels and 'Lane' in tile_df.index.names:
+		lanes = tile_df.index.get_level_values('Lane').values
+		for lane in np.unique(lanes):
+			mask = lanes == lane
+			panels.append((x[mask], y[mask], xcol, ycol, "{} Lane {}".format(run_name, lane), \
+				       prefix + "_L{}.png".format(lane), density(int(mask.sum()))))
+				       
+	if PlotOpts.workers and PlotOpts.workers > 1 and len(panels) > 1:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=min(PlotOpts.workers, len(panels))) as pool:
+			list(pool.map(render_Tile_Plot, *zip(*panels)))
+	else:
+		for panel in panels:
+			render_Tile_Plot(*panel)
+			
+			
+
+def render_Tile_Plot(x, y, xcol, ycol, title, png, density=False):
+	
+	### Renders straight onto an Agg canvas: no pyplot, no interactive backend and no global figure state.
+	### matplotlib is only imported here so that runs which never plot do not pay for it.
+	
+	import numpy as np
+	from matplotlib.figure import Figure
+	from matplotlib.backends.backend_agg import FigureCanvasAgg
+	
+	fig = Figure()
+	FigureCanvasAgg(fig)
+	ax = fig.add_subplot(111)
+	
+	if density:
+		hb = ax.hexbin(x, y, gridsize=100, bins='log', mincnt=1)
+		fig.colorbar(hb, ax=ax, label='Count')
+	else:
+		ax.scatter(x, y)
+		
+	if len(x) and ycol.startswith('%'):
+		ymin = (int((np.nanmin(y))/10)) * 10 - 10
+		ax.set_yticks(np.arange(ymin, 101, 10))
+	if len(x) and xcol.startswith('%'):
+		xmin = (int((np.nanmin(x))/10)) * 10 - 10
+		ax.set_xticks(np.arange(xmin, 101, 10))
+	ax.set_xlabel(xcol)
+	ax.set_ylabel(ycol)
+	ax.set_title(title)
 	
-	plt.savefig(os.path.basename(StreamingPath) + "_" + FlowcellType + '.png')
+	fig.savefig(png)
 	
 	
 			
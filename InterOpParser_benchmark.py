@@ -0,0 +1,444 @@
+#!/usr/local/bin/python3.8
+
+#######################################################################################################
+### Benchmark harness for InterOpParser
+###
+### Generates synthetic NovaSeq run folders (RunInfo.xml plus Tile, ExtendedTile, Extraction, Q and
+### Error InterOp binaries) for the SP, S1, S2 and S4 flowcell geometries, then times
+### calculate_Lane_Metrics, generate_Tile_Plots and the end-to-end CLI (full and --lanes_only) of a parser release.
+### follow_refresh times the refresh of a followed run (-f) after one more cycle is sequenced against a cold
+### parse of the same files, and checks that both give the same lane, per-cycle and tile metrics.
+### Every measurement runs in a fresh child process so wall time and peak RSS are not polluted
+### by earlier stages. Results are written as JSON so releases can be compared offline.
+### Releases that predate the split load/summarize/plot functions are timed as whole stages, and
+### stages a release cannot run (cli_lanes_only without a --lanes_only option) are recorded as skipped.
+###
+###	python InterOpParser_benchmark.py -g S4 -g SP --repeat 3 --json bench.json
+###	python InterOpParser_benchmark.py --parser InterOpParser_0.0.2.py --json old.json
+###
+######################################################################################################
+
+import sys
+import os
+import re
+import argparse
+import importlib.util
+import json
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+import numpy as np
+
+
+### lanes, surfaces, swaths, tiles per swath
+
+GEOMETRIES = { 'SP': (2, 2, 2, 78), 'S1': (2, 2, 2, 78), 'S2': (2, 2, 4, 88), 'S4': (4, 2, 6, 88) }
+
+DEFAULT_PARSER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'InterOpParser_0.0.3.py')
+
+STAGES = ('calculate_Lane_Metrics', 'generate_Tile_Plots', 'cli', 'cli_lanes_only', 'follow_refresh')
+
+### Functions the lane and tile stages are split into; older releases only have the whole stages
+SPLIT_FUNCTIONS = ('load_Run_Metrics', 'summarize_Lane_Metrics', 'write_Lane_Metrics', 'build_Tile_Table', 'plot_Tile_Table')
+
+### Functions follow_refresh needs; older releases re-parse a followed run in full or cannot follow one
+FOLLOW_FUNCTIONS = ('fingerprint_InterOp', 'changed_Metric_Types', 'refresh_Run_Metrics', 'read_Appended_Records')
+
+### CLI options the stages use when the parser's usage text lists them
+CLI_OPTIONS = ('-o', '--lanes_only')
+
+
+### InterOp record layouts: (version, record dtype). All fields are little endian.
+
+TILE_RECORD = (2, np.dtype([('lane', '<u2'), ('tile', '<u2'), ('code', '<u2'), ('value', '<f4')]))
+EXTENDED_TILE_RECORD = (2, np.dtype([('lane', '<u2'), ('tile', '<u4'), ('occupied', '<f4')]))
+EXTRACTION_RECORD = (2, np.dtype([('lane', '<u2'), ('tile', '<u2'), ('cycle', '<u2'), ('fwhm', '<f4', 4), ('intensity', '<u2', 4), ('datetime', '<u8')]))
+Q_RECORD = (4, np.dtype([('lane', '<u2'), ('tile', '<u2'), ('cycle', '<u2'), ('hist', '<u4', 50)]))
+ERROR_RECORD = (3, np.dtype([('lane', '<u2'), ('tile', '<u2'), ('cycle', '<u2'), ('error_rate', '<f4'), ('perfect', '<u4', 5)]))
+
+### Files that get records appended as cycles complete; the others are rewritten
+PER_CYCLE_FILES = { 'ExtractionMetricsOut.bin': EXTRACTION_RECORD, 'QMetricsOut.bin': Q_RECORD, 'ErrorMetricsOut.bin': ERROR_RECORD }
+
+
+def main(argv):
+
+	parser = argparse.ArgumentParser(description="Benchmark InterOpParser on synthetic NovaSeq InterOp fixtures")
+	parser.add_argument("-g", "--geometry", action="append", choices=sorted(GEOMETRIES), help="flowcell geometry; repeatable (default: all)")
+	parser.add_argument("--reads", default="151,8,8,151", help="cycles per read; index reads are the ones with fewer than 26 cycles")
+	parser.add_argument("--tiles", type=int, help="override tiles per swath")
+	parser.add_argument("--lanes", type=int, help="override lane count")
+	parser.add_argument("--repeat", type=int, default=1)
+	parser.add_argument("--parser", default=DEFAULT_PARSER, help="InterOpParser release to benchmark")
+	parser.add_argument("--workdir", help="where fixtures are generated (default: a temporary directory)")
+	parser.add_argument("--keep", action="store_true", help="keep the generated fixtures")
+	parser.add_argument("--json", help="write the results here instead of stdout")
+	parser.add_argument("--stage", help=argparse.SUPPRESS)
+	parser.add_argument("--run", help=argparse.SUPPRESS)
+	parser.add_argument("--type", help=argparse.SUPPRESS)
+	parser.add_argument("--output", help=argparse.SUPPRESS)
+	parser.add_argument("--cli_options", default='', help=argparse.SUPPRESS)
+	args = parser.parse_args(argv)
+
+	if args.stage:
+		cli_options = [option for option in args.cli_options.split(',') if option]
+		print (json.dumps(run_Stage(args.parser, args.stage, args.run, args.type, args.output, cli_options)))
+		return
+
+	reads = [int(cycles) for cycles in args.reads.split(',')]
+	workdir = args.workdir or tempfile.mkdtemp(prefix='interop_bench_')
+	os.makedirs(workdir, exist_ok=True)
+
+	cli_options = parser_Options(args.parser)
+	results = { 'parser': os.path.abspath(args.parser), 'python': sys.version.split()[0], 'reads': reads, 'repeat': args.repeat, \
+		    'cli_options': cli_options, 'geometries': [] }
+	try:
+		for geometry in args.geometry or sorted(GEOMETRIES):
+			lanes, surfaces, swaths, tiles = GEOMETRIES[geometry]
+			lanes = args.lanes or lanes
+			tiles = args.tiles or tiles
+
+			run_path = os.path.join(workdir, "BENCH_{}".format(geometry))
+			start = time.perf_counter()
+			fixture_bytes = generate_Run_Folder(run_path, lanes, surfaces, swaths, tiles, reads)
+			print ("Generated {} fixture ({:.1f} MB) in {:.1f}s".format(geometry, fixture_bytes / 1e6, time.perf_counter() - start), file=sys.stderr)
+
+			result = { 'geometry': geometry, 'lanes': lanes, 'tiles_per_lane': surfaces * swaths * tiles, 'cycles': sum(reads), \
+				   'fixture_bytes': fixture_bytes, 'stages': {} }
+			for stage in STAGES:
+				if stage == 'cli_lanes_only' and '--lanes_only' not in cli_options:
+					result['stages'][stage] = { 'skipped': "the parser has no --lanes_only option" }
+				else:
+					samples = [measure_Stage(args.parser, stage, run_path, geometry, workdir, cli_options) for i in range(args.repeat)]
+					result['stages'][stage] = summarize_Samples(samples)
+				summary = result['stages'][stage]
+				if 'wall_s' in summary:
+					print ("  {:<24} {:8.2f}s {:8.1f} MB".format(stage, summary['wall_s'], summary['peak_rss_mb']), file=sys.stderr)
+					if 'matches_cold_load' in summary:
+						print ("  {:<24} refresh {:.2f}s, cold parse {:.2f}s, same metrics: {}".format('', summary['breakdown_s']['refresh'], \
+							summary['breakdown_s']['cold_load'], summary['matches_cold_load']), file=sys.stderr)
+				else:
+					print ("  {:<24} {}".format(stage, summary.get('skipped') or "failed"), file=sys.stderr)
+
+			results['geometries'].append(result)
+			if not args.keep:
+				shutil.rmtree(run_path)
+	finally:
+		if not args.keep and not args.workdir:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+	if args.json:
+		with open(args.json, 'w') as f:
+			json.dump(results, f, indent=1)
+	else:
+		print (json.dumps(results, indent=1))
+
+
+
+def generate_Run_Folder(run_path, lanes, surfaces, swaths, tiles, reads, seed=0):
+
+	### Synthetic run folder with plausible values; returns the total size of the InterOp files
+
+	rng = np.random.default_rng(seed)
+	interop_path = os.path.join(run_path, 'InterOp')
+	os.makedirs(interop_path, exist_ok=True)
+
+	tile_ids = np.array([surface * 1000 + swath * 100 + tile for surface in range(1, surfaces + 1) \
+			     for swath in range(1, swaths + 1) for tile in range(1, tiles + 1)])
+	lane_col = np.repeat(np.arange(1, lanes + 1), len(tile_ids))
+	tile_col = np.tile(tile_ids, lanes)
+	cycles = sum(reads)
+
+	write_Run_Info(run_path, lanes, surfaces, swaths, tiles, tile_ids, reads)
+
+	### Tile metrics: one record per tile and code
+	non_index = [number for number, read_cycles in enumerate(reads, 1) if read_cycles >= 26]
+	codes = [100, 101, 102, 103] + [code for number in non_index for code in (200 + (number - 1) * 2, 201 + (number - 1) * 2)]
+	density = rng.normal(2800e3, 150e3, len(lane_col))			### clusters/mm2
+	pf_fraction = rng.uniform(0.65, 0.85, len(lane_col))
+	cluster_count = density * 0.67
+	values = { 100: density, 101: density * pf_fraction, 102: cluster_count, 103: cluster_count * pf_fraction }
+	for code in codes[4:]:
+		values[code] = rng.uniform(0.05, 0.2, len(lane_col))
+	records = np.zeros(len(lane_col) * len(codes), dtype=TILE_RECORD[1])
+	records['lane'] = np.repeat(lane_col, len(codes))
+	records['tile'] = np.repeat(tile_col, len(codes))
+	records['code'] = np.tile(codes, len(lane_col))
+	records['value'] = np.stack([values[code] for code in codes], axis=1).ravel()
+	write_InterOp(os.path.join(interop_path, 'TileMetricsOut.bin'), TILE_RECORD, records)
+
+	### Extended tile metrics: occupied clusters, tied to the tile cluster count
+	records = np.zeros(len(lane_col), dtype=EXTENDED_TILE_RECORD[1])
+	records['lane'] = lane_col
+	records['tile'] = tile_col
+	records['occupied'] = cluster_count * rng.uniform(0.85, 0.99, len(lane_col))
+	write_InterOp(os.path.join(interop_path, 'ExtendedTileMetricsOut.bin'), EXTENDED_TILE_RECORD, records)
+
+	### Per cycle metrics: every tile at every cycle, in cycle order as RTA appends them
+	rows = len(lane_col) * cycles
+	lane_cyc = np.tile(lane_col, cycles)
+	tile_cyc = np.tile(tile_col, cycles)
+	cycle_cyc = np.repeat(np.arange(1, cycles + 1), len(lane_col))
+
+	records = np.zeros(rows, dtype=EXTRACTION_RECORD[1])
+	records['lane'], records['tile'], records['cycle'] = lane_cyc, tile_cyc, cycle_cyc
+	records['fwhm'] = rng.uniform(2.3, 2.9, (rows, 4))
+	records['intensity'] = rng.integers(800, 5000, (rows, 4))
+	write_InterOp(os.path.join(interop_path, 'ExtractionMetricsOut.bin'), EXTRACTION_RECORD, records)
+	del records
+
+	records = np.zeros(rows, dtype=Q_RECORD[1])
+	records['lane'], records['tile'], records['cycle'] = lane_cyc, tile_cyc, cycle_cyc
+	hist = records['hist']
+	pf_clusters = np.tile((cluster_count * pf_fraction).astype(np.uint32), cycles)
+	high = (pf_clusters * rng.uniform(0.85, 0.95, rows)).astype(np.uint32)
+	### hist[q - 1] counts the bases of quality q; for NovaSeq runs the interop library only reads the
+	### qualities of its three bins, Q7, Q20 and Q36
+	hist[:, 35] = high
+	hist[:, 19] = (pf_clusters - high) // 2
+	hist[:, 6] = pf_clusters - high - hist[:, 19]
+	write_InterOp(os.path.join(interop_path, 'QMetricsOut.bin'), Q_RECORD, records)
+	del records, hist
+
+	### Error metrics only exist for the aligned (non-index) reads
+	first = np.cumsum([0] + reads[:-1]) + 1
+	aligned = np.concatenate([np.arange(first[number - 1], first[number - 1] + reads[number - 1]) for number in non_index])
+	mask = np.isin(cycle_cyc, aligned)
+	records = np.zeros(int(mask.sum()), dtype=ERROR_RECORD[1])
+	records['lane'], records['tile'], records['cycle'] = lane_cyc[mask], tile_cyc[mask], cycle_cyc[mask]
+	records['error_rate'] = rng.uniform(0.1, 0.6, len(records))
+	write_InterOp(os.path.join(interop_path, 'ErrorMetricsOut.bin'), ERROR_RECORD, records)
+	del records
+
+	return sum(os.path.getsize(os.path.join(interop_path, name)) for name in os.listdir(interop_path))
+
+
+
+def copy_Run_Folder(run_path, follow_path):
+
+	### Copy of a fixture as it was one cycle before the end of sequencing; returns the cycle held back
+
+	interop_path = os.path.join(run_path, 'InterOp')
+	os.makedirs(os.path.join(follow_path, 'InterOp'), exist_ok=True)
+	for name in ('RunInfo.xml', 'RunParameters.xml'):
+		shutil.copyfile(os.path.join(run_path, name), os.path.join(follow_path, name))
+
+	last_cycle = 0
+	for name in os.listdir(interop_path):
+		target = os.path.join(follow_path, 'InterOp', name)
+		if name in PER_CYCLE_FILES:
+			records = np.fromfile(os.path.join(interop_path, name), dtype=PER_CYCLE_FILES[name][1], offset=2)
+			last_cycle = max(last_cycle, int(records['cycle'].max()))
+			write_InterOp(target, PER_CYCLE_FILES[name], records[records['cycle'] < records['cycle'].max()])
+		else:
+			shutil.copyfile(os.path.join(interop_path, name), target)
+
+	return last_cycle
+
+
+
+def sequence_Cycle(run_path, follow_path, cycle):
+
+	### What RTA does to the InterOp folder as a cycle completes: the cycle's records are appended to
+	### the per-cycle files and the other files are rewritten
+
+	interop_path = os.path.join(run_path, 'InterOp')
+	for name in os.listdir(interop_path):
+		target = os.path.join(follow_path, 'InterOp', name)
+		if name in PER_CYCLE_FILES:
+			records = np.fromfile(os.path.join(interop_path, name), dtype=PER_CYCLE_FILES[name][1], offset=2)
+			with open(target, 'ab') as f:
+				records[records['cycle'] == cycle].tofile(f)
+		else:
+			shutil.copyfile(os.path.join(interop_path, name), target)
+
+
+
+def write_InterOp(path, layout, records):
+
+	version, dtype = layout
+	with open(path, 'wb') as f:
+		f.write(bytes([version, dtype.itemsize]))
+		records.tofile(f)
+
+
+
+def write_Run_Info(run_path, lanes, surfaces, swaths, tiles, tile_ids, reads):
+
+	read_xml = "\n".join('      <Read Number="{}" NumCycles="{}" IsIndexedRead="{}" />'.format(number, cycles, "N" if cycles >= 26 else "Y") \
+			     for number, cycles in enumerate(reads, 1))
+	tile_xml = "\n".join("          <Tile>{}_{}</Tile>".format(lane, tile) for lane in range(1, lanes + 1) for tile in tile_ids)
+	run_id = "230118_A00000_0001_A{}".format(os.path.basename(run_path).upper()[-9:])
+
+	with open(os.path.join(run_path, 'RunInfo.xml'), 'w') as f:
+		f.write('''<?xml version="1.0"?>
+<RunInfo Version="5">
+  <Run Id="{}" Number="1">
+    <Flowcell>BENCHDSXX</Flowcell>
+    <Instrument>A00000</Instrument>
+    <Date>1/18/2023 10:00:00 AM</Date>
+    <Reads>
+{}
+    </Reads>
+    <FlowcellLayout LaneCount="{}" SurfaceCount="{}" SwathCount="{}" TileCount="{}">
+      <TileSet TileNamingConvention="FourDigit">
+        <Tiles>
+{}
+        </Tiles>
+      </TileSet>
+    </FlowcellLayout>
+    <ImageChannels>
+      <Name>Red</Name>
+      <Name>Green</Name>
+    </ImageChannels>
+  </Run>
+</RunInfo>
+'''.format(run_id, read_xml, lanes, surfaces, swaths, tiles, tile_xml))
+
+	### The interop library reads the instrument and control software from here
+	with open(os.path.join(run_path, 'RunParameters.xml'), 'w') as f:
+		f.write('''<?xml version="1.0"?>
+<RunParameters>
+  <Side>A</Side>
+  <Application>NovaSeq Control Software</Application>
+  <ApplicationVersion>1.7.5</ApplicationVersion>
+  <RtaVersion>v3.4.4</RtaVersion>
+  <RunId>{}</RunId>
+  <InstrumentType>NovaSeq</InstrumentType>
+</RunParameters>
+'''.format(run_id))
+
+
+
+def parser_Options(parser_path):
+
+	### The CLI_OPTIONS listed in the usage text of the parser release (printed for -h, or for too
+	### few arguments by releases that check the argument count first)
+
+	child = subprocess.run([sys.executable, parser_path, '-h'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	usage = child.stdout.decode('utf-8', 'replace')
+	return [option for option in CLI_OPTIONS if re.search(r'(^|[\s\[|]){}\b'.format(re.escape(option)), usage)]
+
+
+
+def measure_Stage(parser_path, stage, run_path, FlowcellType, workdir, cli_options=()):
+
+	### Runs one stage in a fresh child process, so peak RSS belongs to that stage alone.
+	### A stage that fails is recorded with the tail of its error instead of aborting the benchmark.
+
+	output = os.path.abspath(tempfile.mkdtemp(prefix='out_', dir=workdir))
+	cmd = [sys.executable, os.path.abspath(__file__), '--parser', os.path.abspath(parser_path), '--stage', stage, \
+	       '--run', os.path.abspath(run_path), '--type', FlowcellType, '--output', output, '--cli_options=' + ','.join(cli_options)]
+
+	start = time.perf_counter()
+	child = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	wall = time.perf_counter() - start
+	shutil.rmtree(output, ignore_errors=True)
+
+	if child.returncode != 0:
+		return { 'failed': child.stderr.decode('utf-8', 'replace')[-2000:] }
+
+	sample = json.loads(child.stdout.decode('utf-8').strip().splitlines()[-1])
+	if 'skipped' not in sample:
+		sample['wall_s'] = wall
+	return sample
+
+
+
+def run_Stage(parser_path, stage, run_path, FlowcellType, OutputPath, cli_options=()):
+
+	### Child side of measure_Stage: the stage exactly as the parser runs it, split into its steps
+	### where the release has the split functions and as a whole otherwise. The CLI stage runs the
+	### parser script as this process' only child and reports its RSS. Both run in OutputPath, as
+	### older releases write their outputs to the working directory.
+
+	import resource
+
+	breakdown = {}
+
+	def step(name, func, *args):
+		start = time.perf_counter()
+		value = func(*args)
+		breakdown[name] = time.perf_counter() - start
+		return value
+
+	if stage in ('cli', 'cli_lanes_only'):
+		cmd = [sys.executable, parser_path, '-s', run_path, '-t', FlowcellType]
+		if '-o' in cli_options:
+			cmd += ['-o', OutputPath]
+		if stage == 'cli_lanes_only':
+			if '--lanes_only' not in cli_options:
+				return { 'skipped': "the parser has no --lanes_only option" }
+			cmd.append('--lanes_only')
+		start = time.perf_counter()
+		subprocess.run(cmd, cwd=OutputPath, stdout=subprocess.DEVNULL, check=True)
+		breakdown[stage] = time.perf_counter() - start
+		return { 'breakdown_s': breakdown, 'peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024 }
+
+	spec = importlib.util.spec_from_file_location('InterOpParser', parser_path)
+	iop = importlib.util.module_from_spec(spec)
+	step('import', spec.loader.exec_module, iop)
+	os.chdir(OutputPath)
+
+	if stage == 'follow_refresh':
+		if not all(hasattr(iop, name) for name in FOLLOW_FUNCTIONS):
+			return { 'skipped': "the parser has no incremental refresh of a followed run" }
+		follow_path = os.path.join(OutputPath, 'follow')
+		cycle = copy_Run_Folder(run_path, follow_path)
+		run_metrics = step('load', iop.load_Run_Metrics, follow_path)
+		previous = iop.fingerprint_InterOp(follow_path)
+		sequence_Cycle(run_path, follow_path, cycle)
+		current = iop.fingerprint_InterOp(follow_path)
+		changed = iop.changed_Metric_Types(previous, current)
+		step('refresh', iop.refresh_Run_Metrics, follow_path, run_metrics, changed, previous, current)
+		reference = step('cold_load', iop.load_Run_Metrics, follow_path)
+		matches = all(output(run_metrics) == output(reference) for output in (iop.summarize_Lane_Metrics, iop.summarize_Cycle_Metrics, \
+											  lambda metrics: iop.build_Tile_Table(metrics).to_csv()))
+		return { 'breakdown_s': breakdown, 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, \
+			 'refreshed': list(changed), 'matches_cold_load': matches }
+
+	if not all(hasattr(iop, name) for name in SPLIT_FUNCTIONS):
+		if stage == 'calculate_Lane_Metrics':
+			step(stage, iop.calculate_Lane_Metrics, run_path)
+		elif stage == 'generate_Tile_Plots':
+			step(stage, iop.generate_Tile_Plots, run_path, FlowcellType)
+		else:
+			raise ValueError("Unknown stage {}".format(stage))
+		return { 'breakdown_s': breakdown, 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 }
+
+	run_metrics = step('load', iop.load_Run_Metrics, run_path)
+	if stage == 'calculate_Lane_Metrics':
+		lane_jsons, yield_json = step('summarize', iop.summarize_Lane_Metrics, run_metrics)
+		step('write', iop.write_Lane_Metrics, OutputPath, lane_jsons, yield_json)
+	elif stage == 'generate_Tile_Plots':
+		tile_df = step('tile_table', iop.build_Tile_Table, run_metrics)
+		step('plot', iop.plot_Tile_Table, tile_df, run_path, FlowcellType, OutputPath)
+	else:
+		raise ValueError("Unknown stage {}".format(stage))
+
+	return { 'breakdown_s': breakdown, 'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 }
+
+
+
+def summarize_Samples(samples):
+
+	### A stage skipped or failed in any repeat is reported as such
+
+	for sample in samples:
+		if 'skipped' in sample or 'failed' in sample:
+			return sample
+
+	walls = [sample['wall_s'] for sample in samples]
+	summary = { 'wall_s': statistics.median(walls), 'wall_s_samples': walls }
+	summary['peak_rss_mb'] = max(sample['peak_rss_mb'] for sample in samples)
+	summary['breakdown_s'] = { name: statistics.median(sample['breakdown_s'][name] for sample in samples) for name in samples[0]['breakdown_s'] }
+	if 'matches_cold_load' in samples[0]:
+		summary['refreshed'] = samples[0]['refreshed']
+		summary['matches_cold_load'] = all(sample['matches_cold_load'] for sample in samples)
+	return summary
+
+
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -1,15 +1,16 @@
+import glob
 import os
-import shutil
+import sys
 from pathlib import Path
 
 import pandas as pd
 import numpy as np
 
 import utils.fault_and_resubmission_tolerance as rt
+from utils import cellranger_outputs as co
 from utils import utils as u
 
-import subprocess
-import re
+from concurrent.futures import ThreadPoolExecutor
 
 ##############################################################################
 # Environment Variables
@@ -47,9 +48,17 @@ use_antibody_capture_library = os.environ['ANTIBODY_CAPTURE_LIBRARY'] == 'true'
 antibody_capture_id_column = os.getenv('ANTIBODY_CAPTURE_ID_COLUMN')
 feature_reference = os.getenv('FEATURE_REFERENCE')
 
+# Hashtag branches (bamtofastq + multiomics multi per hashtag)
+ht_concurrency = int(os.getenv('HT_CONCURRENCY') or 0)
+ht_budget_policy = os.getenv('HT_BUDGET_POLICY') or 'even'
+ht_min_threads = int(os.getenv('HT_MIN_THREADS') or 4)
+ht_min_memory = int(os.getenv('HT_MIN_MEMORY_GB') or 16)
+
 # External tools packaged with CellRanger
 bam2fastq_exec = os.getenv("bamtofastq_exec")
-samtools = os.getenv("samtools")
+
+# Wall-clock limit of every cellranger and bamtofastq run (0: none)
+command_timeout = float(os.getenv('COMMAND_TIMEOUT_HOURS') or 0) * 3600 or None
 
 ##############################################################################
 # Input files
@@ -59,13 +68,6 @@ shared_folder = os.getenv('shared_folder')
 fastq_folder = Path(shared_folder, 'fastq_input').absolute().as_posix()
 
 
-##############################################################################
-# Outputs
-##############################################################################
-
-task_output_folder = rt.cleaned_shared_task_folder()
-
-
 ##############################################################################
 # Run once per row in sample sheet
 ##############################################################################
@@ -135,13 +137,38 @@ with open(config_file, 'wt') as file:
     if use_antibody_capture_library:
         pass
 
-u.run_cmd(f"cat {config_file}", outfile=None, error_file=None)
+u.run_cmd(f"cat {config_file}", outfile=None, error_file=None, stage='config')
+
+cellranger_exec = os.path.join(os.getenv("CELLRANGER_DIR"), "cellranger")
+dry_run = os.getenv('CELLRANGER_DRY_RUN') == 'true'
+readsperfq = 75000000
 
 ##############################################################################
-# Run Cell Ranger multi
+# Outputs
+# A resubmitted task resumes at the first stage that is not completed with the
+# same inputs (see Stage Checkpoints in fault_and_resubmission_tolerance).
 ##############################################################################
 
-cellranger_exec = os.path.join(os.getenv("CELLRANGER_DIR"), "cellranger")
+with open(config_file) as file:
+    demux_fingerprint = rt.input_fingerprint(values=[file.read(), cellranger_exec, dry_run],
+                                             files=[fastq_folder])
+run_fingerprint = rt.input_fingerprint(values=[demux_fingerprint, row.to_dict(), bam2fastq_exec, readsperfq,
+                                               gex_reference, vdj_reference, vdj_type, feature_reference])
+
+if rt.stage_completed('output_move', run_fingerprint):
+    u.console_print('Resubmission of task - all stages already completed.')
+    sys.exit(0)
+
+rt.restore_moved_outputs('output_move')
+task_output_folder = rt.cleaned_shared_task_folder()
+
+# Output of the cellranger and bamtofastq runs, teed from the console
+log_folder = Path(task_output_folder, sample_name + '_LOGS')
+log_folder.mkdir()
+
+##############################################################################
+# Run Cell Ranger multi
+##############################################################################
 
 cellranger_memory = int(int(max_memory) / 1024 - 1)
 
@@ -153,11 +180,44 @@ cmd = f'"{cellranger_exec}" multi' \
       f' --localmem {cellranger_memory}' \
       f' --localvmem {cellranger_memory}'
 
-if os.getenv('CELLRANGER_DRY_RUN') == 'true':
+if dry_run:
     cmd += ' --dry'
 
-u.console_print('Running Cell Ranger multi.')
-u.run_cmd(cmd, outfile=None, error_file=None)
+
+def run_demux_multi():
+    u.console_print('Running Cell Ranger multi.')
+    u.run_cmd(cmd, stage='demux_multi', stream=True, timeout=command_timeout,
+              log_file=Path(log_folder, 'demux_multi.log').as_posix())
+
+
+rt.run_stage('demux_multi', demux_fingerprint, [Path(sample_name, 'outs')], run_demux_multi)
+
+##############################################################################
+# Resource budget for the hashtag branches
+##############################################################################
+
+def split_budget(branch_count):
+    """
+    Number of hashtag branches to run at once and the threads / memory (GB) given to each.
+
+    'even' runs up to HT_CONCURRENCY branches at once (0: all of them), as long as every branch
+    still gets HT_MIN_THREADS threads and HT_MIN_MEMORY_GB of memory, and splits max_threads and
+    the cellranger memory evenly between them. 'sequential' runs one branch at a time with the
+    whole budget.
+    """
+    if ht_budget_policy == 'sequential':
+        slots = 1
+    elif ht_budget_policy == 'even':
+        slots = min(branch_count,
+                    ht_concurrency or branch_count,
+                    int(max_threads) // ht_min_threads,
+                    cellranger_memory // ht_min_memory)
+    else:
+        raise Exception(f"Unknown hashtag budget policy '{ht_budget_policy}'.")
+
+    slots = max(slots, 1)
+    return slots, max(int(max_threads) // slots, 1), max(cellranger_memory // slots, 1)
+
 
 ##############################################################################
 # Run BamToFastq
@@ -166,70 +226,65 @@ u.run_cmd(cmd, outfile=None, error_file=None)
 bamfq_path = Path(sample_name + '_BAM2FQ')
 dest_folder = os.path.basename(bamfq_path)
 demux_folder = sample_name + '_DEMUX'
-readsperfq = 75000000
     
 if not os.path.isdir(bamfq_path):
     os.mkdir(bamfq_path)
 
 u.console_print(f"bamfq_path: {bamfq_path}")
 
-for HT in HT_list:
+
+def run_HT_branch(HT, threads, memory):
+    """
+    bamtofastq and the multiomics cellranger multi for one hashtag, each a checkpointed stage.
+    Returns the cellranger output folder and its mri.tgz, which are moved to the task output folder
+    once all branches finished.
+    """
 
     HT = str(HT)
     bam = Path(sample_name, "outs", "per_sample_outs", HT, "count", "sample_alignments.bam").absolute().as_posix()
     metrics = Path(sample_name, "outs", "per_sample_outs", HT, "metrics_summary.csv").absolute().as_posix()
 
     HT_path = Path(bamfq_path, HT).as_posix()
-    rt.clean_up_folder(HT_path)
 
     bam2fq_cmd = f'{bam2fastq_exec}' \
                  f' --traceback' \
-                 f' --nthreads={max_threads}' \
+                 f' --nthreads={threads}' \
                  f' --reads-per-fastq={readsperfq}' \
                  f' {bam}' \
                  f' {bamfq_path}/{HT}'
 
-    u.console_print(f"Running bamtofastq on {bam} file.")
-    u.run_cmd(bam2fq_cmd, outfile=None, error_file=None)
+    def run_bamtofastq():
+        u.console_print(f"Running bamtofastq on {bam} file.")
+        u.run_cmd(bam2fq_cmd, stage='bamtofastq', stream=True, timeout=command_timeout,
+                  log_file=Path(log_folder, f'{HT}_bamtofastq.log').as_posix())
+
+    rt.run_stage(f'bamtofastq_{HT}', rt.input_fingerprint(values=[bam2fastq_exec, readsperfq], files=[bam]), [HT_path],
+                 run_bamtofastq, cleanup=[HT_path])
 
     ##################################################################################
     # Re-Run cellranger multi for multiomics analysis - GEX, VDJ and Antibody Capture
     # Code needs to be refactored. This is just a quick and dirty implementation here.
     # Include error checking code in the refactored version.
     ##################################################################################
-    gex_cmd = f'{samtools}' \
-              f' view -H {bam}' \
-              f' | grep "Gene Expression"'
+    myval = co.get_library_id(bam, 'Gene Expression')
 
-    libinfo = subprocess.getoutput(gex_cmd)
-    m = re.search('"library_id":\d+', libinfo)
-    myval = int(m.group(0).split(":")[1])
-    
     #################################################################################
     # Find the corresponding GEX library files in the bamfq_path
     #################################################################################
-    RGcmd =  f'ls -d {HT_path}/{sample_name}_{myval}_*'
-    gexfolder = subprocess.getoutput(RGcmd)
+    gexfolder = co.find_single(Path(glob.escape(HT_path), f'{glob.escape(sample_name)}_{myval}_*').as_posix(),
+                               'bamtofastq Gene Expression folder')
     gexfolder = os.path.abspath(gexfolder)
 
     ################################################################################
     # Extract number of cells assigned to the sample
     ################################################################################
-    cellscmd = f"grep 'Cells assigned to this sample'" \
-               f" {metrics}"
-    
-    cellsstr = subprocess.getoutput(cellscmd)
-    
-    c = re.search('Cells assigned to this sample,"\d+,?\d+\s', cellsstr)
-    
-    force_cells = c.group(0).split("\"")[1]
-    force_cells = int(force_cells.replace(',',''))
+    force_cells = co.get_metric_count(metrics, 'Cells assigned to this sample')
 
     ################################################################################
     # Generate the config file required by the Cell Ranger multiomics pipeline.
     ################################################################################
 
-    multiomics_config_file = sample_name + '_vdj_fb_config.csv'
+    multiomics_config_file = f'{sample_name}_{HT}_vdj_fb_config.csv'
 
     with open(multiomics_config_file, 'wt') as file:
 
@@ -262,39 +317,61 @@ for HT in HT_list:
         file.write(f'reference,{feature_reference}\n')
         file.write('\n')
 
-    u.run_cmd(f"cat {multiomics_config_file}", outfile=None, error_file=None)
+    u.run_cmd(f"cat {multiomics_config_file}", outfile=None, error_file=None, stage='config')
+    with open(multiomics_config_file) as file:
+        multiomics_fingerprint = rt.input_fingerprint(values=[file.read(), cellranger_exec, dry_run],
+                                                      files=[gexfolder])
 
     ###################################################################################
     ###################################################################################
     # Run Cell Ranger multi for multiomics datasets
-    # Not parallelized at this time, but consider a subprocess here for parallelization
+    # Runs concurrently with the other hashtag branches within its share of the budget
     ###################################################################################
 
     cmd = f'"{cellranger_exec}" multi' \
           f' --id={sample_name}_{HT}' \
           f' --csv={multiomics_config_file}' \
           f' --disable-ui' \
-          f' --localcores {int(max_threads)}' \
-          f' --localmem {cellranger_memory}' \
-          f' --localvmem {cellranger_memory}'
+          f' --localcores {threads}' \
+          f' --localmem {memory}' \
+          f' --localvmem {memory}'
 
-    if os.getenv('CELLRANGER_DRY_RUN') == 'true':
+    if dry_run:
         cmd += ' --dry'
 
-    u.console_print('Running Cell Ranger multi for multiomics datasets.')
-    u.run_cmd(cmd, outfile=None, error_file=None)
-
     finaldir = sample_name + '_' + HT
-    mri_find = f'ls {finaldir}/*mri.tgz'
-    mri_file = subprocess.getoutput(mri_find)
 
-    shutil.move(Path(finaldir, 'outs').as_posix(), Path(task_output_folder, finaldir).as_posix())
-    shutil.move(Path(mri_file), Path(task_output_folder, finaldir).as_posix())
-    
+    def run_multiomics_multi():
+        u.console_print('Running Cell Ranger multi for multiomics datasets.')
+        u.run_cmd(cmd, stage='multiomics_multi', stream=True, timeout=command_timeout,
+                  log_file=Path(log_folder, f'{HT}_multiomics_multi.log').as_posix())
+        mri_file = co.find_single(Path(glob.escape(finaldir), '*mri.tgz').as_posix(), 'mri.tgz')
+        return finaldir, mri_file
+
+    finaldir, mri_file = rt.run_stage(f'multiomics_multi_{HT}', multiomics_fingerprint,
+                                      [Path(finaldir, 'outs')], run_multiomics_multi)
+    return finaldir, mri_file
+
+
+HT_slots, HT_threads, HT_memory = split_budget(len(HT_list))
+u.console_print(f"Running {len(HT_list)} hashtag branch(es), {HT_slots} at a time, "
+                f"with {HT_threads} threads and {HT_memory} GB each.")
+
+with ThreadPoolExecutor(max_workers=HT_slots) as executor:
+    HT_branches = [executor.submit(run_HT_branch, HT, HT_threads, HT_memory) for HT in HT_list]
+
+# Outputs are moved in sample sheet order once every branch has finished
+output_moves = []
+for HT_branch in HT_branches:
+    finaldir, mri_file = HT_branch.result()
+    output_moves.append((Path(finaldir, 'outs').as_posix(), Path(task_output_folder, finaldir).as_posix()))
+    output_moves.append((mri_file, Path(task_output_folder, finaldir, os.path.basename(mri_file)).as_posix()))
+
 ##############################################################################
 # Create Output Files
 ##############################################################################
 
-shutil.move(Path(sample_name, 'outs').as_posix(), Path(task_output_folder, demux_folder).as_posix())
-shutil.move(Path(bamfq_path), Path(task_output_folder, dest_folder).as_posix())
+output_moves.append((Path(sample_name, 'outs').as_posix(), Path(task_output_folder, demux_folder).as_posix()))
+output_moves.append((bamfq_path.as_posix(), Path(task_output_folder, dest_folder).as_posix()))
+rt.move_outputs('output_move', run_fingerprint, output_moves)
 
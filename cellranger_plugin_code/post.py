@@ -3,11 +3,22 @@ import shutil
 from pathlib import Path
 
 import utils.fault_and_resubmission_tolerance as rt
+from utils import command_profile
+from utils import export
 from utils import utils as u
 
 generic_output_layer = os.getenv('output_generic_data_0')
 
 
+##############################################################################
+# Command Profile
+##############################################################################
+
+if command_profile.profiling_enabled() and os.path.isdir(rt.get_profile_folder()):
+    u.console_print("Resources used per stage over all tasks:\n" + command_profile.format_summary(
+        command_profile.summarize(command_profile.read_timelines([rt.get_profile_folder()]))))
+
+
 ##############################################################################
 # Export Results
 ##############################################################################
@@ -16,17 +27,26 @@ export_results = os.environ['POST_COMMAND_EXPORT_RESULTS'] == "true"
 export_folder = os.getenv('POST_COMMAND_EXPORT_FOLDER')
 
 u.console_print("Exporting Results to Data Lake")
+task_output_folders = []
 index: int = 0
-while True:
-    task_output_folder = rt.get_shared_task_folder(index)
-    if not os.path.isdir(task_output_folder):
-        break
-    if export_results:
-        export_ignore = None
-        if os.environ['POST_COMMAND_EXPORT_EXCLUDE_BAM'] == "true":
-            export_ignore = shutil.ignore_patterns('*.bam', '*.bam.bai')
-        shutil.copytree(task_output_folder, export_folder, dirs_exist_ok=True, ignore=export_ignore)
-    if generic_output_layer is not None:
+while os.path.isdir(rt.get_shared_task_folder(index)):
+    task_output_folders.append(rt.get_shared_task_folder(index))
+    index += 1
+
+if export_results:
+    export_ignore = None
+    if os.environ['POST_COMMAND_EXPORT_EXCLUDE_BAM'] == "true":
+        export_ignore = shutil.ignore_patterns('*.bam', '*.bam.bai')
+    export_stats = export.export_folders([(folder, export_folder) for folder in task_output_folders],
+                                         ignore=export_ignore,
+                                         threads=int(os.getenv('POST_COMMAND_EXPORT_THREADS') or 8),
+                                         compare=os.getenv('POST_COMMAND_EXPORT_COMPARE') or export.SIZE_MTIME,
+                                         hardlink=os.getenv('POST_COMMAND_EXPORT_HARDLINK', 'true') == "true")
+    u.console_print(f"Exported {export_stats['linked']} file(s) as hardlinks and copied {export_stats['copied']} "
+                    f"({export_stats['bytes'] / 1024 ** 3:.1f} GB in total), {export_stats['skipped']} unchanged "
+                    f"file(s) skipped.")
+
+if generic_output_layer is not None:
+    for task_output_folder in task_output_folders:
         for e in os.listdir(task_output_folder):
             shutil.move(Path(task_output_folder, e), Path(generic_output_layer, 'cellranger_multi', e))
-    index += 1
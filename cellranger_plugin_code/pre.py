@@ -4,6 +4,7 @@ from pathlib import Path
 import pandas as pd
 
 import utils.fault_and_resubmission_tolerance as rt
+from utils import fastq_validation as fv
 from utils import utils as u
 
 
@@ -14,6 +15,20 @@ from utils import utils as u
 shared_folder = os.getenv('shared_folder')
 files_per_sample = int(os.environ['NUMBER_FILES_PER_SAMPLE'])
 sample_sheet = os.environ['SAMPLE_SHEET']
+sample_id_column = os.environ['SAMPLE_ID_COLUMN']
+
+validate_fastq = os.getenv('PRE_COMMAND_VALIDATE_FASTQ') == 'true'
+# Validation decompresses on every thread, so it stays within the threads reserved for the PreCommand
+# (1 in activity.xml; raise the PreCommand threads there to validate in parallel)
+validation_threads = min(int(os.getenv('PRE_COMMAND_VALIDATION_THREADS') or 8),
+                         int(os.getenv('max_threads') or 8))
+
+# Sample sheet columns holding the fastq_ids of the libraries in use
+fastq_id_columns = [os.getenv(column) for library, column in [('GENE_EXPRESSION_LIBRARY', 'GEX_ID_COLUMN'),
+                                                             ('VDJ_LIBRARY', 'VDJ_ID_COLUMN'),
+                                                             ('MULTIPLEXING_CAPTURE_LIBRARY', 'MULTIPLEXING_ID_COLUMN'),
+                                                             ('ANTIBODY_CAPTURE_LIBRARY', 'ANTIBODY_CAPTURE_ID_COLUMN')]
+                    if os.getenv(library) == 'true']
 
 
 ##############################################################################
@@ -50,3 +65,38 @@ sample_sheet_df = pd.read_csv(sample_sheet, sep='\t')
 if len(sample_sheet_df.index) * files_per_sample != i:
     u.error_and_out(f"Number of lines in selected sample sheet ({len(sample_sheet_df.index)}) does not match number "
                     f"of samples. Input Files: {i}. Files per Sample: {files_per_sample}.")
+
+
+##############################################################################
+# Validate FASTQ files
+# Every FASTQ is read to the end, so corrupt or truncated files fail here rather than hours
+# into cellranger multi. Reads and bases are written to one manifest per sample.
+##############################################################################
+
+if validate_fastq:
+    fastq_paths = sorted(Path(fastq_folder, f).as_posix() for f in os.listdir(fastq_folder))
+    u.console_print(f"Validating {len(fastq_paths)} FASTQ files with {validation_threads} threads.")
+    fastq_results = fv.validate_fastqs(fastq_paths, validation_threads)
+
+    manifest_folder = rt.clean_up_and_ensure_folder(Path(shared_folder, 'fastq_manifest').as_posix())
+    assigned = set()
+    for _, sample_row in sample_sheet_df.iterrows():
+        sample_fastq_ids = {str(sample_row[column]) for column in fastq_id_columns
+                            if column in sample_row and not pd.isna(sample_row[column])}
+        sample_results = [r for r in fastq_results if fv.fastq_id(r['file']) in sample_fastq_ids]
+        assigned.update(r['file'] for r in sample_results)
+        sample_name = str(sample_row[sample_id_column])
+        fv.write_manifest(Path(manifest_folder, u.safe_filename(sample_name) + '.tsv').as_posix(), sample_results)
+        u.console_print(f"Sample {sample_name}: {len(sample_results)} FASTQ files, "
+                        f"{sum(r['reads'] for r in sample_results)} reads, "
+                        f"{sum(r['bases'] for r in sample_results)} bases.")
+    unassigned = [r for r in fastq_results if r['file'] not in assigned]
+    if unassigned:
+        fv.write_manifest(Path(manifest_folder, '_unassigned.tsv').as_posix(), unassigned)
+        u.console_print('FASTQ files not matching a fastq_id of the sample sheet:\n'
+                        + "\n".join(os.path.basename(r['file']) for r in unassigned))
+
+    failed = [r for r in fastq_results if r['status'] != 'ok']
+    if failed:
+        u.error_and_out("Invalid FASTQ files:\n" + "\n".join(f"{os.path.basename(r['file'])}: {r['status']}"
+                                                              for r in failed))
@@ -0,0 +1,123 @@
+import csv
+import glob
+import gzip
+import json
+import re
+import struct
+
+from utils.utils import ActivityException
+
+BAM_MAGIC = b"BAM\x01"
+
+
+##############################################################################
+# BAM header
+##############################################################################
+
+def read_bam_header(bam_path):
+    """
+    Reads the SAM header text of a BAM file without samtools.
+
+    BAM is a series of BGZF blocks, each a gzip member, and gzip decompresses lazily, so only the
+    blocks holding the magic, the header length and the header text are read from disk.
+
+    :param str bam_path: A path to a BAM file
+    :return: the header text (the @HD, @SQ, @RG, @PG and @CO lines)
+    :rtype: str
+    """
+    try:
+        with gzip.open(bam_path, 'rb') as bam:
+            magic = bam.read(4)
+            if magic != BAM_MAGIC:
+                raise ActivityException(f"{bam_path} is not a BAM file (magic {magic!r}).")
+            l_text, = struct.unpack('<i', bam.read(4))
+            text = bam.read(l_text)
+    except (OSError, EOFError, struct.error) as e:
+        raise ActivityException(f"Could not read the header of {bam_path}: {e}")
+
+    if len(text) != l_text:
+        raise ActivityException(f"{bam_path} is truncated inside its header.")
+    return text.rstrip(b"\0").decode("utf-8")
+
+
+def read_library_info(bam_path):
+    """
+    :param str bam_path: A cellranger BAM file
+    :return: the library_info records cellranger stores as @CO header lines
+    :rtype: list[dict]
+    """
+    libraries = []
+    for line in read_bam_header(bam_path).splitlines():
+        if line.startswith("@CO\tlibrary_info:"):
+            libraries.append(json.loads(line[len("@CO\tlibrary_info:"):]))
+    return libraries
+
+
+def get_library_id(bam_path, library_type="Gene Expression"):
+    """
+    :param str bam_path: A cellranger BAM file
+    :param str library_type: cellranger library type, e.g. Gene Expression
+    :return: library_id of the library of that type
+    :rtype: int
+    """
+    libraries = read_library_info(bam_path)
+    for library in libraries:
+        if library.get("library_type") == library_type:
+            return int(library["library_id"])
+    raise ActivityException(f"No {library_type} library in the header of {bam_path}. Libraries found: "
+                            f"{[library.get('library_type') for library in libraries]}.")
+
+
+##############################################################################
+# metrics_summary.csv
+##############################################################################
+
+def read_metrics_summary(metrics_path):
+    """
+    :param str metrics_path: A cellranger multi per sample metrics_summary.csv
+    :return: one dict per metric, keyed on the csv header (Category, Library Type, ..., Metric Name,
+        Metric Value)
+    :rtype: list[dict]
+    """
+    try:
+        with open(metrics_path, newline='') as f:
+            return list(csv.DictReader(f))
+    except OSError as e:
+        raise ActivityException(f"Could not read {metrics_path}: {e}")
+
+
+def get_metric_count(metrics_path, metric_name):
+    """
+    Integer value of a metric such as 'Cells assigned to this sample', whose value is formatted like
+    "1,234" or "1,234 (79.34%)".
+
+    :param str metrics_path: A cellranger multi per sample metrics_summary.csv
+    :param str metric_name: the Metric Name column value
+    :rtype: int
+    """
+    for metric in read_metrics_summary(metrics_path):
+        if metric.get("Metric Name") == metric_name:
+            m = re.match(r"\s*(\d[\d,]*)", metric.get("Metric Value") or "")
+            if m is None:
+                raise ActivityException(f"'{metric_name}' in {metrics_path} is not a count: "
+                                        f"{metric.get('Metric Value')!r}.")
+            return int(m.group(1).replace(",", ""))
+    raise ActivityException(f"No '{metric_name}' metric in {metrics_path}.")
+
+
+##############################################################################
+# Output discovery
+##############################################################################
+
+def find_single(pattern, description="file"):
+    """
+    :param str pattern: glob pattern that should match exactly one path
+    :param str description: what is being looked for, for the error message
+    :return: the matching path
+    :rtype: str
+    """
+    matches = sorted(glob.glob(pattern))
+    if len(matches) != 1:
+        raise ActivityException(f"Expected one {description} matching {pattern}, found {len(matches)}: "
+                                f"{matches}.")
+    return matches[0]
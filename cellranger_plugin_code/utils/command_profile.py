@@ -0,0 +1,131 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import utils.fault_and_resubmission_tolerance as rt
+
+_timeline_lock = threading.Lock()
+
+
+##############################################################################
+# Recording
+##############################################################################
+
+def profiling_enabled():
+    return os.getenv('PROFILE_COMMANDS') == 'true'
+
+
+def timeline_path(task_index=None):
+    """
+    One JSON lines timeline per task (and one for the pre and post commands, which run outside of
+    the tasks) in the shared folder, appended to across resubmissions.
+    """
+    if task_index is None:
+        task_index = os.getenv('task_index', 'plugin')
+    return os.path.join(rt.get_profile_folder(), f"{task_index}.jsonl")
+
+
+def record(cmd, stage, started, wall_time, rusage, returncode):
+    """
+    Appends one command to the timeline of the task.
+
+    :param str cmd: the command as run
+    :param str stage: label of the plugin stage the command belongs to, e.g. bamtofastq
+    :param float started: start as seconds since the epoch
+    :param float wall_time: seconds
+    :param rusage: resource usage of the command and its descendants as returned by os.wait4
+    :param int returncode: exit status of the command
+    """
+    entry = OrderedDict([
+        ('task_index', os.getenv('task_index')),
+        ('stage', stage),
+        ('start', datetime.fromtimestamp(started).isoformat(timespec='seconds')),
+        ('wall_s', round(wall_time, 3)),
+        ('user_s', round(rusage.ru_utime, 3)),
+        ('sys_s', round(rusage.ru_stime, 3)),
+        # ru_maxrss is in kilobytes on Linux, and never below the RSS of the plugin process the command
+        # was forked from
+        ('max_rss_mb', round(rusage.ru_maxrss / 1024, 1)),
+        ('returncode', returncode),
+        ('cmd', cmd),
+    ])
+    path = timeline_path()
+    with _timeline_lock:
+        rt._create_folder_safe(os.path.dirname(path))
+        with open(path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+
+##############################################################################
+# Summary
+##############################################################################
+
+def read_timelines(paths):
+    """
+    :param paths: timeline files or folders holding them
+    :return: all entries of the timelines
+    :rtype: list[dict]
+    """
+    entries = []
+    for path in paths:
+        files = sorted(glob.glob(os.path.join(glob.escape(path), '*.jsonl'))) if os.path.isdir(path) else [path]
+        for file in files:
+            with open(file) as f:
+                entries.extend(json.loads(line) for line in f if line.strip())
+    return entries
+
+
+def summarize(entries):
+    """
+    Per stage over all tasks: commands, failed commands, total and maximum wall time, CPU time
+    (user + sys), average cores used while running and the peak RSS of a single command.
+
+    :rtype: list[dict]
+    """
+    stages = OrderedDict()
+    for entry in entries:
+        stage = stages.setdefault(entry.get('stage') or '-', OrderedDict([
+            ('stage', entry.get('stage') or '-'), ('commands', 0), ('failed', 0), ('tasks', set()),
+            ('wall_s', 0.0), ('max_wall_s', 0.0), ('cpu_s', 0.0), ('max_rss_mb', 0.0)]))
+        stage['commands'] += 1
+        stage['failed'] += entry['returncode'] != 0
+        stage['tasks'].add(entry.get('task_index'))
+        stage['wall_s'] += entry['wall_s']
+        stage['max_wall_s'] = max(stage['max_wall_s'], entry['wall_s'])
+        stage['cpu_s'] += entry['user_s'] + entry['sys_s']
+        stage['max_rss_mb'] = max(stage['max_rss_mb'], entry['max_rss_mb'])
+
+    summary = []
+    for stage in stages.values():
+        stage['tasks'] = len(stage['tasks'])
+        stage['avg_cores'] = stage['cpu_s'] / stage['wall_s'] if stage['wall_s'] else 0.0
+        summary.append(stage)
+    return summary
+
+
+def format_summary(summary):
+    columns = ['stage', 'tasks', 'commands', 'failed', 'wall_s', 'max_wall_s', 'cpu_s', 'avg_cores', 'max_rss_mb']
+    rows = [columns] + [[f"{stage[c]:.1f}" if isinstance(stage[c], float) else str(stage[c]) for c in columns]
+                        for stage in summary]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return "\n".join("  ".join(value.ljust(width) for value, width in zip(row, widths)) for row in rows)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Summarize the command profiles of cellranger plugin tasks, e.g. "
+                                                 "python -m utils.command_profile <shared_folder>/_task_profiles")
+    parser.add_argument('paths', nargs='+', help="timeline files or folders holding them")
+    parser.add_argument('--json', action='store_true', help="print the summary as JSON")
+    args = parser.parse_args(argv)
+
+    summary = summarize(read_timelines(args.paths))
+    print(json.dumps(summary, indent=1) if args.json else format_summary(summary))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
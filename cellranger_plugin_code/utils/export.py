@@ -0,0 +1,128 @@
+import hashlib
+import os
+import shutil
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+SIZE_MTIME = 'size_mtime'
+CHECKSUM = 'checksum'
+
+# Modification times survive copy2 only to the resolution of the destination filesystem
+MTIME_TOLERANCE = 1.0
+
+
+##############################################################################
+# Export Plan
+##############################################################################
+
+def plan_export(folder_pairs, ignore=None):
+    """
+    Files and folders to export, like shutil.copytree(source, destination, dirs_exist_ok=True,
+    ignore=ignore) for each pair in turn: when pairs share a destination file the last one wins.
+
+    :param folder_pairs: (source folder, destination folder) pairs
+    :param ignore: a shutil.ignore_patterns() callable, or None
+    :return: the destination folders to create and the {destination file: source file} to export
+    :rtype: (list[str], dict)
+    """
+    folders = []
+    files = {}
+    for source_root, destination_root in folder_pairs:
+        for root, dirs, names in os.walk(source_root, followlinks=True):
+            ignored = ignore(root, dirs + names) if ignore is not None else set()
+            dirs[:] = sorted(d for d in dirs if d not in ignored)
+            destination = os.path.join(destination_root, os.path.relpath(root, source_root))
+            folders.append(os.path.normpath(destination))
+            for name in sorted(names):
+                if name not in ignored:
+                    files[os.path.normpath(os.path.join(destination, name))] = os.path.join(root, name)
+    return folders, files
+
+
+##############################################################################
+# Export
+##############################################################################
+
+def export_folders(folder_pairs, ignore=None, threads=8, compare=SIZE_MTIME, hardlink=True):
+    """
+    Exports the files of the source folders into the destination folders in parallel. A file
+    already exported is skipped when it matches on size and modification time (or checksum), a
+    file on the same device as its destination is hardlinked when hardlink is set and copied with
+    its metadata otherwise.
+
+    :param folder_pairs: (source folder, destination folder) pairs
+    :param ignore: a shutil.ignore_patterns() callable, or None
+    :param int threads: number of files exported at once
+    :param str compare: SIZE_MTIME or CHECKSUM, how an existing destination file is checked
+    :param bool hardlink: hardlink instead of copy where possible
+    :return: number of files per outcome (skipped, linked, copied) and the bytes linked or copied
+    :rtype: Counter
+    """
+    folders, files = plan_export(folder_pairs, ignore)
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+
+    stats = Counter()
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        for outcome, size in executor.map(lambda item: export_file(item[1], item[0], compare, hardlink),
+                                          files.items()):
+            stats[outcome] += 1
+            if outcome != 'skipped':
+                stats['bytes'] += size
+    return stats
+
+
+def export_file(source, destination, compare=SIZE_MTIME, hardlink=True):
+    """
+    :return: 'skipped', 'linked' or 'copied', and the size of the file
+    :rtype: (str, int)
+    """
+    source_stat = os.stat(source)
+    try:
+        destination_stat = os.stat(destination)
+    except FileNotFoundError:
+        destination_stat = None
+
+    if destination_stat is not None and is_unchanged(source, source_stat, destination, destination_stat, compare):
+        return 'skipped', source_stat.st_size
+
+    # Replaced rather than overwritten, so a destination hardlinked by an earlier export never
+    # changes the file it is linked to
+    temporary = f"{destination}.{os.getpid()}.tmp"
+    if hardlink and source_stat.st_dev == os.stat(os.path.dirname(destination)).st_dev:
+        try:
+            os.link(source, temporary)
+            os.replace(temporary, destination)
+            return 'linked', source_stat.st_size
+        except OSError:
+            # e.g. filesystems without hardlinks or links across bind mounts
+            if os.path.lexists(temporary):
+                os.remove(temporary)
+
+    try:
+        shutil.copy2(source, temporary)
+        os.replace(temporary, destination)
+    finally:
+        if os.path.lexists(temporary):
+            os.remove(temporary)
+    return 'copied', source_stat.st_size
+
+
+def is_unchanged(source, source_stat, destination, destination_stat, compare=SIZE_MTIME):
+    if (source_stat.st_dev, source_stat.st_ino) == (destination_stat.st_dev, destination_stat.st_ino):
+        return True
+    if source_stat.st_size != destination_stat.st_size:
+        return False
+    if compare == CHECKSUM:
+        return file_checksum(source) == file_checksum(destination)
+    if compare == SIZE_MTIME:
+        return abs(source_stat.st_mtime - destination_stat.st_mtime) <= MTIME_TOLERANCE
+    raise ValueError(f"Unknown export comparison '{compare}'.")
+
+
+def file_checksum(path, block_size=4 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
@@ -0,0 +1,145 @@
+import csv
+import gzip
+import os
+import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# bcl2fastq / BCL Convert names as cellranger expects them, e.g. GEX_S1_L001_R1_001.fastq.gz
+FASTQ_NAME = re.compile(r"^(?P<fastq_id>.+)_S\d+(_L\d{3})?_[RI]\d_\d{3}\.f(ast)?q(\.gz)?$")
+
+MANIFEST_COLUMNS = ["file", "fastq_id", "reads", "bases", "bytes", "status"]
+
+
+##############################################################################
+# Single FASTQ
+##############################################################################
+
+def validate_fastq(path, block_size=4 * 1024 * 1024):
+    """
+    Reads a FASTQ to the end, which makes gzip check the CRC and length of every member, and counts
+    its reads and bases. Every record needs an @ header, a + separator and as many qualities as
+    bases, and the file has to end with a newline, so a FASTQ cut inside its last record is caught
+    even when the cut (or the last gzip member) happens to end cleanly.
+
+    :param str path: A plain or gzipped FASTQ
+    :param int block_size: decompressed bytes processed at once
+    :return: file, reads, bases, bytes (on disk) and status ('ok' or what is wrong)
+    :rtype: dict
+    """
+    result = {"file": path, "reads": 0, "bases": 0, "bytes": os.path.getsize(path), "status": "ok"}
+    try:
+        with open(path, 'rb') as f:
+            gzipped = f.read(2) == GZIP_MAGIC
+        with (gzip.open(path, 'rb') if gzipped else open(path, 'rb')) as fastq:
+            reads, bases, problem = count_records(fastq, block_size)
+    except (OSError, EOFError, zlib.error) as e:
+        # truncated or corrupt gzip members end up here
+        result["status"] = f"corrupt: {e}"
+        return result
+
+    result["reads"], result["bases"] = reads, bases
+    if problem is not None:
+        result["status"] = problem
+    elif reads == 0:
+        result["status"] = "empty"
+    return result
+
+
+def count_records(stream, block_size=4 * 1024 * 1024):
+    """
+    Counts and checks the records of a FASTQ block by block. Only whole records are checked, the
+    lines of a record cut by the end of a block are carried over to the next one, so the per record
+    work stays in bytes.split, slicing and map.
+
+    :return: number of records and bases up to the first bad record, and what is wrong with the
+        file (None if nothing)
+    :rtype: (int, int, str)
+    """
+    reads = 0
+    bases = 0
+    remainder = b""
+    for block in iter(lambda: stream.read(block_size), b""):
+        lines = (remainder + block).split(b"\n")
+        # the last element is the line still being read, or b"" after a newline
+        whole = (len(lines) - 1) // 4 * 4
+        remainder = b"\n".join(lines[whole:])
+        good, problem = check_records(lines[:whole], reads)
+        reads += good
+        bases += sum(map(len, lines[1:good * 4:4]))
+        if problem is not None:
+            return reads, bases, problem
+
+    if not remainder:
+        return reads, bases, None
+    if not remainder.endswith(b"\n"):
+        return reads, bases, f"truncated: no newline at the end of record {reads + 1}"
+    line_count = remainder.count(b"\n")
+    return reads, bases, f"truncated: record {reads + 1} has only {line_count} of 4 lines"
+
+
+def check_records(lines, first_record=0):
+    """
+    :param lines: whole 4 line records
+    :param int first_record: number of records before them in the file
+    :return: number of records before the first bad one, and what is wrong with it (None if all
+        records are fine)
+    :rtype: (int, str)
+    """
+    headers, sequences, separators, qualities = lines[0::4], lines[1::4], lines[2::4], lines[3::4]
+    if (all(map(bytes.startswith, headers, repeat(b"@")))
+            and all(map(bytes.startswith, separators, repeat(b"+")))
+            and list(map(len, sequences)) == list(map(len, qualities))):
+        return len(headers), None
+
+    # something is wrong; find out what, record by record
+    for good, (header, sequence, separator, quality) in enumerate(zip(headers, sequences, separators, qualities)):
+        number = first_record + good + 1
+        if not header.startswith(b"@"):
+            return good, f"not a FASTQ: record {number} header {header[:50]!r}"
+        if not separator.startswith(b"+"):
+            return good, f"truncated: record {number} separator {separator[:50]!r} instead of +"
+        if len(sequence) != len(quality):
+            return good, f"truncated: record {number} has {len(sequence)} bases but {len(quality)} qualities"
+    return len(headers), None
+
+
+##############################################################################
+# All FASTQs
+##############################################################################
+
+def validate_fastqs(paths, threads=8):
+    """
+    Validates the FASTQs in parallel; gzip decompression releases the GIL, so threads scale with the
+    cores available.
+
+    :param paths: FASTQ paths
+    :param int threads: number of FASTQs read at once
+    :return: validate_fastq() results in the order of paths
+    :rtype: list[dict]
+    """
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        return list(executor.map(validate_fastq, paths))
+
+
+def fastq_id(path):
+    """
+    :return: the cellranger fastq_id of a FASTQ file name, or None if the name does not follow the
+        bcl2fastq convention
+    """
+    m = FASTQ_NAME.match(os.path.basename(path))
+    return m.group("fastq_id") if m else None
+
+
+def write_manifest(manifest_path, results):
+    """
+    Writes validate_fastqs() results as a tab separated manifest with the file name and fastq_id.
+    """
+    with open(manifest_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=MANIFEST_COLUMNS, delimiter='\t')
+        writer.writeheader()
+        for result in results:
+            writer.writerow(dict(result, file=os.path.basename(result["file"]), fastq_id=fastq_id(result["file"])))
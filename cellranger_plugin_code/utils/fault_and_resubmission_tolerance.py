@@ -1,5 +1,8 @@
 import glob
+import hashlib
+import json
 import os
+import re
 import shutil
 
 failedTracksFolder = os.path.join(str(os.getenv("shared_folder")), "__failed_tracks__")
@@ -51,6 +54,10 @@ def get_shared_task_folder(task_index):
     return os.path.join(os.getenv("shared_folder"), '_task_outputs', str(task_index))
 
 
+def get_profile_folder():
+    return os.path.join(os.getenv("shared_folder"), '_task_profiles')
+
+
 def get_shared_task_folders(paired: bool = False):
     # Only compatible with the Genome module for now.
     sample_count = int(os.getenv('total_samples_0'))
@@ -65,6 +72,129 @@ def get_shared_task_folders(paired: bool = False):
     return res
 
 
+##############################################################################
+# Stage Checkpoints
+#
+# A stage that completes writes a marker with the fingerprint of its inputs, its outputs and
+# its result to _task_checkpoints/<task_index> in the shared folder, which is not cleaned up on
+# resubmission. A resubmitted task skips a stage whose marker matches the current fingerprint
+# while all of its outputs still exist, and reruns it (after cleaning up) otherwise.
+##############################################################################
+
+def get_checkpoint_folder(task_index=None):
+    if task_index is None:
+        task_index = os.getenv("task_index")
+    return os.path.join(os.getenv("shared_folder"), '_task_checkpoints', str(task_index))
+
+
+def input_fingerprint(values=(), files=()):
+    """
+    Fingerprint of the values (anything json serializable) and the files a stage reads. Files are
+    fingerprinted on path, size and modification time; folders on all files below them.
+    """
+    digest = hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode())
+    for path in sorted(_list_files(files)):
+        stat = os.stat(path)
+        digest.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def stage_completed(stage, fingerprint):
+    marker = _read_marker(stage)
+    return (marker is not None and marker.get("status") == "completed"
+            and marker["fingerprint"] == fingerprint
+            and all(os.path.exists(path) for path in marker["outputs"]))
+
+
+def run_stage(stage, fingerprint, outputs, func, *args, cleanup=()):
+    """
+    Runs func(*args) as a checkpointed stage and returns its result.
+
+    :param str stage: unique stage name within the task
+    :param str fingerprint: input_fingerprint() of everything the stage depends on
+    :param outputs: paths the stage produces; all must exist for the stage to count as completed
+    :param func: the stage; its return value must be json serializable
+    :param cleanup: paths removed before the stage is (re)run
+    :return: the result of func, or the recorded result if the stage was already completed
+    """
+    if stage_completed(stage, fingerprint):
+        print(f"Resubmission of task - stage {stage} already completed, skipping it.")
+        return _read_marker(stage)["result"]
+
+    clean_up_file(_marker_path(stage))
+    for path in cleanup:
+        if os.path.isdir(path):
+            clean_up_folder(path)
+        else:
+            clean_up_file(path)
+
+    result = func(*args)
+    _write_marker(stage, {"status": "completed", "fingerprint": fingerprint,
+                          "outputs": [os.path.abspath(path) for path in outputs], "result": result})
+    return result
+
+
+def move_outputs(stage, fingerprint, moves):
+    """
+    Moves (source, destination) pairs as a checkpointed stage. The moves are recorded before the
+    first one starts, so that restore_moved_outputs() can undo an interrupted stage.
+    """
+    moves = [(os.path.abspath(source), os.path.abspath(destination)) for source, destination in moves]
+    _write_marker(stage, {"status": "moving", "fingerprint": fingerprint, "moves": moves})
+    for source, destination in moves:
+        if os.path.isdir(destination):
+            clean_up_folder(destination)
+        shutil.move(source, destination)
+    _write_marker(stage, {"status": "completed", "fingerprint": fingerprint, "moves": moves,
+                          "outputs": [destination for source, destination in moves], "result": None})
+
+
+def restore_moved_outputs(stage):
+    """
+    Moves what an interrupted or outdated move_outputs() stage moved back to the sources, so the
+    stages that produced them can be found completed again. Call it only when
+    stage_completed() is False for the stage.
+    """
+    marker = _read_marker(stage)
+    if marker is None or "moves" not in marker:
+        return
+    for source, destination in reversed(marker["moves"]):
+        if os.path.exists(destination) and not os.path.exists(source):
+            print(f"Resubmission of task - restoring {source} moved by stage {stage}.")
+            shutil.move(destination, source)
+    clean_up_file(_marker_path(stage))
+
+
+def _marker_path(stage):
+    return os.path.join(get_checkpoint_folder(), re.sub('[^A-Za-z0-9._-]', '_', stage) + ".json")
+
+
+def _read_marker(stage):
+    try:
+        with open(_marker_path(stage)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_marker(stage, marker):
+    _create_folder_safe(get_checkpoint_folder())
+    tmp = f"{_marker_path(stage)}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(marker, f, indent=1)
+    os.replace(tmp, _marker_path(stage))
+
+
+def _list_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path, followlinks=True):
+                for name in files:
+                    yield os.path.join(root, name)
+        elif os.path.exists(path):
+            yield path
+
+
 ##############################################################################
 # Fault Tolerance
 ##############################################################################
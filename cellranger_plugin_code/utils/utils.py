@@ -3,12 +3,27 @@ import os
 import platform
 import re
 import shutil
+import signal
 import subprocess
 import sys
 import tarfile
+import threading
+import time
 import traceback
+from collections import deque
 from io import IOBase
 
+from utils import command_profile
+
+# Streaming output of run_cmd: lines kept for the error message, longest line read at once
+TAIL_LINES = 200
+STREAM_LINE_LIMIT = 64 * 1024
+
+# Seconds between SIGTERM and SIGKILL for a command that timed out
+KILL_GRACE_PERIOD = 30
+
+_console_lock = threading.Lock()
+
 
 class ActivityException(Exception):
     """
@@ -58,7 +73,8 @@ def escape_command(command):
         return command
 
 
-def run_cmd(cmd, outfile=subprocess.PIPE, error_file=subprocess.PIPE, print_cmd=True, escape_cmd=True):
+def run_cmd(cmd, outfile=subprocess.PIPE, error_file=subprocess.PIPE, print_cmd=True, escape_cmd=True, stage=None,
+            stream=False, log_file=None, timeout=None, tail_lines=TAIL_LINES):
     """
 
     Runs the passed shell command
@@ -71,7 +87,13 @@ def run_cmd(cmd, outfile=subprocess.PIPE, error_file=subprocess.PIPE, print_cmd=
     :param error_file:
     :param print_cmd:
     :param escape_cmd:
-    :return:
+    :param stage: label of the command in the command profile, recorded when PROFILE_COMMANDS is true
+    :param stream: tee stdout and stderr line by line to the console (and log_file) instead of outfile and error_file,
+        keeping only the last tail_lines lines of each for the error message
+    :param log_file: path the streamed output is appended to
+    :param timeout: seconds after which the command and everything it started is terminated
+    :param tail_lines: lines of streamed output kept for the error message
+    :return: the output for outfile=subprocess.PIPE without stream, else the return code
     """
 
     sys.stdout.flush()
@@ -99,22 +121,121 @@ def run_cmd(cmd, outfile=subprocess.PIPE, error_file=subprocess.PIPE, print_cmd=
         sys.stdout.flush()
 
     try:
-        out = subprocess.run(cmd, shell=True, stdout=outfile, stderr=error_file, check=True)
-        if outfile == subprocess.PIPE:
+        if stream or timeout is not None or command_profile.profiling_enabled():
+            out = _run_process(cmd, outfile, error_file, stage, stream, log_file, timeout, tail_lines)
+        else:
+            out = subprocess.run(cmd, shell=True, stdout=outfile, stderr=error_file, check=True)
+        if outfile == subprocess.PIPE and not stream:
             sys.stdout.write(out.stdout.decode("utf-8"))
             return out.stdout.decode("utf-8")
         else:
             return out.returncode
-    except subprocess.CalledProcessError as e:
-        error_message = "System call returned a non-zero exit status={0} for command '{1}'.".format(
-            e.returncode, e.cmd)
-        if outfile == subprocess.PIPE:
-            error_message += "\nstdout: {0}".format(e.stdout.decode("utf-8"))
-        if error_file == subprocess.PIPE:
-            error_message += "\nstderr: {0}".format(e.stderr.decode("utf-8"))
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        if isinstance(e, subprocess.TimeoutExpired):
+            error_message = "System call timed out after {0:g} seconds for command '{1}'.".format(e.timeout, e.cmd)
+        else:
+            error_message = "System call returned a non-zero exit status={0} for command '{1}'.".format(
+                e.returncode, e.cmd)
+        tail = " (last {0} lines)".format(tail_lines) if stream else ""
+        if stream or outfile == subprocess.PIPE:
+            error_message += "\nstdout{0}: {1}".format(tail, (e.stdout or b"").decode("utf-8", errors="replace"))
+        if stream or error_file == subprocess.PIPE:
+            error_message += "\nstderr{0}: {1}".format(tail, (e.stderr or b"").decode("utf-8", errors="replace"))
         raise RuntimeError(error_message)
 
 
+def _run_process(cmd, outfile, error_file, stage=None, stream=False, log_file=None, timeout=None,
+                 tail_lines=TAIL_LINES):
+    """
+    subprocess.run(cmd, shell=True, check=True, timeout=timeout) for what subprocess.run does not do:
+
+    - The command is reaped with os.wait4, whose resource usage covers the command and all of its descendants only,
+      and recorded in the command profile when profiling is enabled.
+    - stream tees stdout and stderr line by line to the console and log_file, keeping the last tail_lines lines of
+      each instead of the whole output.
+    - With a timeout, the command runs in its own process group, which gets SIGTERM when the timeout expires and
+      SIGKILL KILL_GRACE_PERIOD seconds later, so nothing the command started keeps running.
+    """
+    started = time.time()
+    start = time.perf_counter()
+    if stream:
+        outfile = error_file = subprocess.PIPE
+    process = subprocess.Popen(cmd, shell=True, stdout=outfile, stderr=error_file,
+                               start_new_session=timeout is not None)
+
+    # Drain the pipes like communicate() does, which would reap the process itself
+    output = {}
+    log = open(log_file, 'ab') if stream and log_file else None
+    readers = []
+    for name, pipe, console in (('stdout', process.stdout, sys.stdout), ('stderr', process.stderr, sys.stderr)):
+        if pipe is None:
+            continue
+        if stream:
+            output[name] = deque(maxlen=tail_lines)
+            readers.append(threading.Thread(target=_tee_lines, args=(pipe, console, log, output[name])))
+        else:
+            readers.append(threading.Thread(target=lambda name, pipe: output.update({name: pipe.read()}),
+                                            args=(name, pipe)))
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    reaped = {}
+    waiter = threading.Thread(target=lambda: reaped.update(zip(('pid', 'status', 'rusage'),
+                                                               os.wait4(process.pid, 0))))
+    waiter.daemon = True
+    waiter.start()
+    waiter.join(timeout)
+    timed_out = waiter.is_alive()
+    if timed_out:
+        console_print("Command timed out after {0:g} seconds, terminating it.".format(timeout))
+        _signal_process_group(process.pid, signal.SIGTERM)
+        waiter.join(KILL_GRACE_PERIOD)
+        _signal_process_group(process.pid, signal.SIGKILL)
+        waiter.join()
+
+    for reader in readers:
+        # Descendants that left the process group could keep the pipes open
+        reader.join(KILL_GRACE_PERIOD if timed_out else None)
+    if log is not None:
+        with _console_lock:
+            log.close()
+    for pipe in (process.stdout, process.stderr):
+        if pipe is not None:
+            pipe.close()
+
+    status = reaped['status']
+    process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    if command_profile.profiling_enabled():
+        command_profile.record(cmd, stage, started, time.perf_counter() - start, reaped['rusage'], process.returncode)
+
+    stdout, stderr = output.get('stdout'), output.get('stderr')
+    if stream:
+        stdout, stderr = b"".join(stdout or []), b"".join(stderr or [])
+    if timed_out:
+        raise subprocess.TimeoutExpired(cmd, timeout, stdout, stderr)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+
+def _tee_lines(pipe, console, log, tail):
+    for line in iter(lambda: pipe.readline(STREAM_LINE_LIMIT), b""):
+        tail.append(line)
+        with _console_lock:
+            console.write(line.decode("utf-8", errors="replace"))
+            console.flush()
+            if log is not None and not log.closed:
+                log.write(line)
+
+
+def _signal_process_group(pgid, sig):
+    try:
+        os.killpg(pgid, sig)
+    except ProcessLookupError:
+        pass
+
+
 def gunzip(filename):
     """
 
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+#####################################################################################
+##### Throughput benchmark for the data migration tool
+##### Generates a synthetic masterfile (projects with count matrices and metadata.csv files),
+##### a rules xml matching config.ini, and migrates it against fake_gdp.py with the given
+##### latency, bandwidth and failure rate. Reports files/sec, bytes/sec and the time spent in
+##### each migration phase as JSON. --rerun times a second pass against the upload journal.
+##### Every fake gdp call is a Python process start, so on hosts with few cores set --latency to
+##### the real server's round trip to keep the numbers about the migration rather than the fake.
+#####
+#####   python datamigration_benchmark.py --projects 2000 --files 3 --latency 0.05
+#####   python datamigration_benchmark.py --workers 1 --workers 8 --workers 32 --json bench.json
+#####################################################################################
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import configparser
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SCRIPT = os.path.join(HERE, "datamigration_prod-v.0.0.1.py")
+FAKE_GDP = os.path.join(HERE, "fake_gdp.py")
+PARENT_FOLDER = "folder-00000000-0000-0000-0000-000000000000"
+
+#### Allowed values per metadata.csv column of the synthetic rules
+RULE_VALUES = ["Oncology", "Virology", "Inflammation", "Homo sapiens", "Mus musculus"]
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the data migration tool against a local fake gdp"
+    )
+    parser.add_argument("--projects", type=int, default=1000)
+    parser.add_argument(
+        "--files", type=int, default=2, help="count matrices per project"
+    )
+    parser.add_argument(
+        "--file_kb", type=int, default=64, help="size of every count matrix"
+    )
+    parser.add_argument(
+        "--metadata_fraction",
+        type=float,
+        default=0.5,
+        help="fraction of projects that come with a metadata.csv",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        action="append",
+        help="upload workers; repeatable (default: 8)",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds added to every gdp call"
+    )
+    parser.add_argument(
+        "--upload_mbps", type=float, default=0.0, help="simulated upload bandwidth"
+    )
+    parser.add_argument(
+        "--failure_rate", type=float, default=0.0, help="fraction of failed uploads"
+    )
+    parser.add_argument(
+        "--upload_folder_id",
+        action="store_true",
+        help="let the fake gdp accept gdp data upload --folder-id",
+    )
+    parser.add_argument(
+        "--compress", default="none", help="passed on to the migration tool"
+    )
+    parser.add_argument(
+        "--sparse", default="none", help="passed on to the migration tool"
+    )
+    parser.add_argument(
+        "--rerun", action="store_true", help="also time a re-run against the journal"
+    )
+    parser.add_argument("--script", default=DEFAULT_SCRIPT)
+    parser.add_argument(
+        "--workdir",
+        help="where fixtures are generated (default: a temporary directory)",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the generated fixtures"
+    )
+    parser.add_argument("--json", help="write the results here instead of stdout")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="datamigration_bench_")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        fixtures = generate_fixtures(
+            workdir, args.projects, args.files, args.file_kb, args.metadata_fraction
+        )
+        results = {
+            "script": os.path.abspath(args.script),
+            "settings": {
+                key: getattr(args, key)
+                for key in (
+                    "projects",
+                    "files",
+                    "file_kb",
+                    "metadata_fraction",
+                    "latency",
+                    "upload_mbps",
+                    "failure_rate",
+                    "upload_folder_id",
+                    "compress",
+                    "sparse",
+                )
+            },
+            "runs": [],
+        }
+        for workers in args.workers or [8]:
+            rundir = os.path.join(workdir, f"workers_{workers}")
+            passes = ["cold", "rerun"] if args.rerun else ["cold"]
+            for name in passes:
+                result = run_migration(args, fixtures, rundir, workers)
+                result.update(workers=workers, run=name)
+                results["runs"].append(result)
+                print(
+                    f"{name} workers={workers}: {result['wall_s']:.1f}s,"
+                    f" {result['files_per_s']:.1f} files/s,"
+                    f" {result['bytes_per_s'] / 1e6:.1f} MB/s",
+                    file=sys.stderr,
+                )
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir)
+
+    if args.json:
+        with open(args.json, "w") as json_obj:
+            json.dump(results, json_obj, indent=1)
+    else:
+        print(json.dumps(results, indent=1))
+
+
+def generate_fixtures(workdir, projects, files, file_kb, metadata_fraction):
+    """Masterfile, rules xml, config.ini and the data files it points to"""
+    datadir = os.path.join(workdir, "data")
+    os.makedirs(datadir, exist_ok=True)
+
+    config = configparser.RawConfigParser()
+    config.optionxform = str
+    config.read(os.path.join(HERE, "config.ini"))
+    mapping = dict(config.items("PROD"))
+    shutil.copy(os.path.join(HERE, "config.ini"), workdir)
+
+    xmlfile = os.path.join(workdir, "rules.xml")
+    with open(xmlfile, "w") as xml_obj:
+        xml_obj.write("<MetadataRules>\n")
+        for attrname in mapping:
+            items = "".join(f"<Item>{value}</Item>" for value in RULE_VALUES)
+            xml_obj.write(
+                f'<Rule attributeName="{attrname}"><Dictionary>{items}</Dictionary></Rule>\n'
+            )
+        xml_obj.write("</MetadataRules>\n")
+
+    columns = sorted({column for column in mapping.values() if column})
+    payload = count_matrix(file_kb * 1024)
+
+    masterfile = os.path.join(workdir, "masterfile.csv")
+    with open(masterfile, "w") as master:
+        master.write("Project,Data Type,Count Matrix,Sample Metadata\n")
+        for index in range(projects):
+            project = f"SCL-{index:06d}"
+            countfiles = []
+            for count in range(files):
+                countfile = os.path.join(datadir, f"{project}_count{count}.txt")
+                with open(countfile, "wb") as count_obj:
+                    count_obj.write(payload)
+                countfiles.append(countfile)
+
+            metadatfile = ""
+            if index < projects * metadata_fraction:
+                metadatfile = os.path.join(datadir, f"{project}_metadata.csv")
+                with open(metadatfile, "w") as met_obj:
+                    met_obj.write(",".join(columns) + "\n")
+                    met_obj.write(
+                        ",".join(
+                            RULE_VALUES[(index + i) % len(RULE_VALUES)]
+                            for i in range(len(columns))
+                        )
+                        + "\n"
+                    )
+            master.write(f"{project},RNA,{chr(9).join(countfiles)},{metadatfile}\n")
+
+    return {"masterfile": masterfile, "xml": xmlfile, "workdir": workdir}
+
+
+def count_matrix(size, samples=8, seed=0):
+    """Tab separated genes x samples counts of about size bytes, mostly zeros like real data"""
+    rng = random.Random(seed)
+    lines = ["gene\t" + "\t".join(f"sample{i}" for i in range(samples))]
+    length = len(lines[0])
+    while length < size:
+        counts = (
+            str(rng.randint(1, 500)) if rng.random() < 0.2 else "0"
+            for _ in range(samples)
+        )
+        lines.append(f"ENSG{len(lines):011d}\t" + "\t".join(counts))
+        length += len(lines[-1]) + 1
+    return ("\n".join(lines) + "\n").encode()
+
+
+def run_migration(args, fixtures, rundir, workers):
+    """Migrate the fixtures once from rundir and summarize the upload log"""
+    os.makedirs(rundir, exist_ok=True)
+    env = dict(
+        os.environ,
+        FAKE_GDP_STATE=os.path.join(rundir, "gdp_state"),
+        FAKE_GDP_LATENCY=str(args.latency),
+        FAKE_GDP_UPLOAD_FAILURE_RATE=str(args.failure_rate),
+        FAKE_GDP_UPLOAD_MBPS=str(args.upload_mbps),
+        FAKE_GDP_UPLOAD_FOLDER_ID="1" if args.upload_folder_id else "0",
+    )
+    upload_log = os.path.join(rundir, "upload_log.jsonl")
+    timings = os.path.join(rundir, "timings.json")
+    if os.path.exists(upload_log):
+        os.remove(upload_log)
+
+    cmd = [
+        sys.executable,
+        os.path.abspath(args.script),
+        "--file", fixtures["masterfile"],
+        "--xml", fixtures["xml"],
+        "--config", os.path.join(fixtures["workdir"], "config.ini"),
+        "--parent_folder", PARENT_FOLDER,
+        "--gdp", FAKE_GDP,
+        "--workers", str(workers),
+        "--backoff", "0.01",
+        "--folder_map", os.path.join(rundir, "folder_map.json"),
+        "--rules_cache", os.path.join(rundir, "metadata_rules.json"),
+        "--journal", os.path.join(rundir, "migration_journal.db"),
+        "--upload_log", upload_log,
+        "--timings", timings,
+        "--compress", args.compress,
+        "--sparse", args.sparse,
+    ]  # fmt: skip
+    start = time.perf_counter()
+    completed = subprocess.run(cmd, cwd=rundir, env=env, stdout=subprocess.DEVNULL)
+    wall = time.perf_counter() - start
+
+    outcomes = []
+    if os.path.exists(upload_log):
+        with open(upload_log, "r") as log_obj:
+            outcomes = [json.loads(line) for line in log_obj]
+    uploaded = [outcome for outcome in outcomes if outcome["status"] == "uploaded"]
+    with open(timings, "r") as timings_obj:
+        phases = json.load(timings_obj)
+
+    upload_s = phases.get("uploads") or wall
+    uploaded_bytes = sum(outcome["size"] for outcome in uploaded)
+    transferred_bytes = sum(outcome["uploaded_size"] for outcome in uploaded)
+    return {
+        "returncode": completed.returncode,
+        "wall_s": wall,
+        "phases_s": phases,
+        "files_uploaded": len(uploaded),
+        "files_failed": sum(outcome["status"] == "failed" for outcome in outcomes),
+        "bytes_uploaded": uploaded_bytes,
+        "bytes_transferred": transferred_bytes,
+        "retries": sum(max(outcome["attempts"] - 1, 0) for outcome in outcomes),
+        "files_per_s": len(uploaded) / upload_s,
+        "bytes_per_s": uploaded_bytes / upload_s,
+    }
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,149 +1,1011 @@
-#####################################################################################
-##### Data migration tool to transfer data from on-prem to genedata datalake
-##### Sirisha Sunkara; 01/18/2023
-##### gdp client needs to be setup on-prem to talk to either the dev. or prod. server
-#####################################################################################
-
-import pandas as pd
-import xmltodict
-import re
-import subprocess
-import argparse
-import configparser
-from pathlib import Path
-
-parser = argparse.ArgumentParser()
-parser.add_argument("--file", type=str, required=True)
-parser.add_argument(
-    "--parent_folder", type=str, default="folder-1ff52e14-05a2-448c-a745-fd9654989b00"
-)
-parser.add_argument("--xml", type=str, required=True)
-args = parser.parse_args()
-
-masterfile = args.file
-parent_folder = args.parent_folder
-xmlfile = args.xml
-
-gdpclient = "/export/home/ssunkara1/.python3.8/bin/gdp"
-
-
-############################################################################
-#### Read config.ini file
-#### config.ini maps the fields in the xml to the metadata.csv column names
-#### config.optionxform = str to retain case
-############################################################################
-
-config = configparser.RawConfigParser()
-config.optionxform = str
-config.read("config.ini")
-config_dict = dict(config.items("PROD"))
-
-###############################################################
-#### Extract attributes from xml
-###############################################################
-with open(xmlfile, "r") as xml_obj:
-    xml_dict = xmltodict.parse(xml_obj.read())
-    xml_obj.close()
-
-attributecount = len(xml_dict["MetadataRules"]["Rule"])
-metadatadict = {}
-
-for _ in range(1, attributecount):
-    metadatadict[xml_dict["MetadataRules"]["Rule"][_]["@attributeName"]] = xml_dict[
-        "MetadataRules"]["Rule"][_]["Dictionary"]["Item"]
-
-
-def parse_metadata(met, metadatadict):
-    project_dict = {}
-    metadata_csv = pd.read_csv(met, encoding="windows-1254")
-
-    for (
-        attrname
-    ) in (
-        metadatadict.keys()
-    ):  #### For each attribute in the xml file, run through the attibute values
-        metadatafileCol = config_dict[attrname]
-        if (
-            metadatafileCol
-        ):  #### If corresponding column was mappable to the metadata.csv column
-            if (
-                metadatafileCol in metadata_csv
-            ):  #### Not all metadata columns exist in all metadata.csv files
-                for attrval in metadatadict[attrname]:
-                    if re.search(str(metadata_csv[metadatafileCol][0]), attrval, re.I):
-                        project_dict[repr(attrname)] = repr(attrval)
-        elif attrname == "Access Tag":
-            project_dict[repr("Access Tag")] = "Internal"
-        else:
-            project_dict[attrname] = ""
-
-    return project_dict
-
-
-#############################################################################################
-#### Read info from Ruidong's project masterfile
-#### Expected format: Project,Data Type,Count Matrix,Sample Metadata
-#### Additional implementation - if folder in datalake already exists, do not create another
-#############################################################################################
-with open(masterfile, "r") as master:
-    for line in master.readlines():
-        if re.search("^SCL", line):
-            project, dattype, countmat, metadat = line.strip().split(",")
-            countfiles = countmat.split("\t")
-            metadatfiles = metadat.split("\t")
-
-            foldersearch = f'gdp data search "Name = {project}" -o "id"'
-            createfolder = f"gdp data mkdir --folder-id {parent_folder} {project}"
-            cdfolder = f"gdp data cd --folder-id {parent_folder} {project}"
-
-            subprocess.run(["gdp clear"], shell=True)
-            folderid = subprocess.run(
-                foldersearch, shell=True, capture_output=True, encoding="utf-8"
-            )
-
-            if folderid.returncode != 0:
-                subprocess.run(createfolder, shell=True)
-                subprocess.run(cdfolder, shell=True)
-
-            if metadat:
-                for met in metadatfiles:
-                    project_dict = parse_metadata(met, metadatadict)
-                    cpmet = f"gdp data upload -m 'SCL Project Id'={project}"
-
-                    for projectkey in project_dict:
-                        if project_dict[projectkey]:
-                            cpmet += f" -m {projectkey}={project_dict[projectkey]}"
-                    cpmet += f" {met}"
-
-                    subprocess.run(cpmet, shell=True)
-
-                ### If the metadata.csv file is available, extract the tags for the count.txt from the metadata.csv
-                if countmat:
-                    for count in countfiles:
-                        cpcount = f"gdp data upload -m 'SCL Project Id'={project}"
-                        for projectkey in project_dict:
-                            if project_dict[projectkey]:
-                                cpcount += (
-                                    f" -m {projectkey}={project_dict[projectkey]}"
-                                )
-                        cpcount += f" {count}"
-
-                        subprocess.run(cpcount, shell=True)
-
-            elif (
-                countmat
-            ):  ### If only count matrix files are available, upload them with hard-coded metadata tags for now
-                for count in countfiles:
-                    cpcount = (
-                        f'gdp data upload -m "SCL Project Id"={project}'
-                        f' -m "Access Tag"="Internal"'
-                        f' -m "Analyte"="RNA"'
-                        f' -m "Sequencing Application"="mRNA-seq"'
-                        f' -m "Sequencing Platform"="Illumina"'
-                        f' -m "Data Source"="Gilead Sequencing Core"'
-                        f' -m "Analysis Type"="Bulk RNASeq"'
-                        f" {count}"
-                    )
-                    subprocess.run(cpcount, shell=True)
-            else:
-                print(f"No Files to upload for {project}")
+#####################################################################################
+##### Data migration tool to transfer data from on-prem to genedata datalake
+##### Sirisha Sunkara; 01/18/2023
+##### gdp client needs to be setup on-prem to talk to either the dev. or prod. server
+#####################################################################################
+
+import csv
+import os
+import re
+import json
+import gzip
+import hashlib
+import time
+import sqlite3
+import random
+import zipfile
+import itertools
+import shlex
+import shutil
+import tempfile
+import subprocess
+import argparse
+import configparser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--file", type=str, required=True)
+parser.add_argument(
+    "--parent_folder", type=str, default="folder-1ff52e14-05a2-448c-a745-fd9654989b00"
+)
+parser.add_argument("--xml", type=str, required=True)
+parser.add_argument(
+    "--gdp",
+    type=str,
+    default=os.environ.get("GDP_CLIENT", "gdp"),
+    help="gdp client executable (default: $GDP_CLIENT, else gdp on the PATH)",
+)
+parser.add_argument(
+    "--config",
+    type=str,
+    default="config.ini",
+    help="Maps the xml attributes to metadata.csv column names",
+)
+parser.add_argument("--config_section", type=str, default="PROD")
+parser.add_argument(
+    "--rules_cache",
+    type=str,
+    default="metadata_rules.json",
+    help="Compiled xml rules and config mapping, rebuilt when either file changes",
+)
+parser.add_argument(
+    "--workers", type=int, default=8, help="Number of concurrent gdp uploads"
+)
+parser.add_argument(
+    "--retries", type=int, default=3, help="Retries per file after a failed upload"
+)
+parser.add_argument(
+    "--backoff",
+    type=float,
+    default=5.0,
+    help="Seconds before the first retry; doubled on every further retry",
+)
+parser.add_argument(
+    "--folder_map",
+    type=str,
+    default="folder_map.json",
+    help="Saved project to datalake folder id map, reused between runs",
+)
+parser.add_argument(
+    "--journal",
+    type=str,
+    default="migration_journal.db",
+    help="SQLite journal of completed uploads; unchanged files are skipped on re-runs ('' disables)",
+)
+parser.add_argument(
+    "--force",
+    action="store_true",
+    help="Upload every file again, ignoring the journal",
+)
+parser.add_argument(
+    "--compress",
+    choices=["none", "gzip"],
+    default="none",
+    help="Compress count matrices before upload; the codec is added as a Compression tag",
+)
+parser.add_argument(
+    "--compress_threads",
+    type=int,
+    default=4,
+    help="Threads compressing blocks, shared by all uploads",
+)
+parser.add_argument("--compress_level", type=int, default=6)
+parser.add_argument(
+    "--sparse",
+    choices=["none", "alongside", "instead"],
+    default="none",
+    help="Also upload (or upload only) count matrices converted to a sparse CSR .npz",
+)
+parser.add_argument(
+    "--compress_dir",
+    type=str,
+    default="compressed",
+    help="Where compressed or converted count matrices are staged until they are uploaded",
+)
+parser.add_argument(
+    "--timings",
+    type=str,
+    help="Write the seconds spent in each migration phase to this JSON file",
+)
+parser.add_argument(
+    "--upload_log",
+    type=str,
+    default="upload_log.jsonl",
+    help="Per-file upload outcomes, one JSON record per line",
+)
+args = parser.parse_args()
+
+masterfile = args.file
+parent_folder = args.parent_folder
+xmlfile = args.xml
+
+gdpclient = shlex.quote(args.gdp)
+
+
+############################################################################
+#### Read config.ini file
+#### config.ini maps the fields in the xml to the metadata.csv column names
+#### config.optionxform = str to retain case
+############################################################################
+def read_config(configfile, section):
+    config = configparser.RawConfigParser()
+    config.optionxform = str
+    if not config.read(configfile):
+        raise FileNotFoundError(f"Could not read {configfile}")
+    return dict(config.items(section))
+
+
+###############################################################
+#### Extract attributes from xml
+###############################################################
+def read_metadata_rules(xmlfile):
+    """Attribute name -> list of allowed values for every <Rule> in the xml"""
+    import xmltodict
+
+    with open(xmlfile, "r") as xml_obj:
+        xml_dict = xmltodict.parse(xml_obj.read())
+
+    rules = xml_dict["MetadataRules"]["Rule"]
+    if isinstance(rules, dict):  #### a single <Rule> is not returned as a list
+        rules = [rules]
+
+    metadatadict = {}
+    for rule in rules:
+        items = (rule.get("Dictionary") or {}).get("Item") or []
+        if isinstance(items, str):  #### neither is a single <Item>
+            items = [items]
+        metadatadict[rule["@attributeName"]] = items
+    return metadatadict
+
+
+#############################################################################################
+#### Metadata attribute index
+#### The rules are compiled once into {attribute: (metadata.csv column, {lowercase value: value})}
+#### so tagging a metadata.csv is a dictionary lookup per mapped column.
+#############################################################################################
+def compile_attribute_index(metadatadict, config_dict):
+    attribute_index = {}
+    for attrname, attrvals in metadatadict.items():
+        attribute_index[attrname] = (
+            config_dict.get(attrname, ""),
+            {str(attrval).lower(): attrval for attrval in attrvals},
+        )
+    return attribute_index
+
+
+#############################################################################################
+#### Compiled rules cache
+#### The attribute index is saved to --rules_cache together with the mtime, size and sha256
+#### of the xml and config.ini it was built from. It is reused while the mtime and size are
+#### unchanged, or while the content hash is unchanged (e.g. after a copy or touch), and is
+#### rebuilt otherwise.
+#############################################################################################
+RULES_CACHE_VERSION = 1
+
+
+def source_stamp(path, digest=True):
+    stat = os.stat(path)
+    stamp = {
+        "path": os.path.abspath(path),
+        "mtime_ns": stat.st_mtime_ns,
+        "size": stat.st_size,
+    }
+    if digest:
+        with open(path, "rb") as source_obj:
+            stamp["sha256"] = hashlib.sha256(source_obj.read()).hexdigest()
+    return stamp
+
+
+def cached_rules_valid(cached, sources):
+    """(valid, touched) for the cached source stamps; touched stamps are refreshed in place"""
+    if len(cached) != len(sources):
+        return False, False
+    touched = False
+    for saved, path in zip(cached, sources):
+        current = source_stamp(path, digest=False)
+        if saved["path"] != current["path"]:
+            return False, False
+        if (saved["mtime_ns"], saved["size"]) != (current["mtime_ns"], current["size"]):
+            current = source_stamp(path)
+            if saved["sha256"] != current["sha256"]:
+                return False, False
+            saved.update(current)
+            touched = True
+    return True, touched
+
+
+def load_metadata_rules(xmlfile, configfile, section="PROD", cache_path=None):
+    """Attribute index for xmlfile and configfile, from cache_path when it is still valid"""
+    sources = [xmlfile, configfile]
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, "r") as cache_obj:
+                cached = json.load(cache_obj)
+            if (
+                cached["version"] == RULES_CACHE_VERSION
+                and cached["section"] == section
+            ):
+                valid, touched = cached_rules_valid(cached["sources"], sources)
+                if valid:
+                    if touched:
+                        write_rules_cache(cache_path, cached)
+                    return cached["attribute_index"]
+        except (OSError, ValueError, KeyError) as error:
+            print(f"Rebuilding {cache_path}: {error}")
+
+    attribute_index = compile_attribute_index(
+        read_metadata_rules(xmlfile), read_config(configfile, section)
+    )
+    if cache_path:
+        write_rules_cache(
+            cache_path,
+            {
+                "version": RULES_CACHE_VERSION,
+                "section": section,
+                "sources": [source_stamp(path) for path in sources],
+                "attribute_index": attribute_index,
+            },
+        )
+    return attribute_index
+
+
+def write_rules_cache(cache_path, cached):
+    tmp = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as cache_obj:
+        json.dump(cached, cache_obj)
+    os.replace(tmp, cache_path)
+
+
+def read_first_row(met, columns):
+    """Header and first row of a metadata.csv, restricted to the given columns"""
+    with open(met, "r", encoding="windows-1254", newline="") as met_obj:
+        rows = csv.reader(met_obj)
+        header = next(rows, [])
+        first = next(rows, [])
+    return {
+        col: val.strip()
+        for col, val in zip(header, first)
+        if col in columns and val.strip()
+    }
+
+
+def match_attribute(value, values):
+    """
+    Exact case-insensitive match first, then the last allowed value containing the csv value, as
+    the re.search loop this replaces kept overwriting its match ("Cancer" in ["Breast Cancer",
+    "Lung Cancer"] is tagged "Lung Cancer"). Unlike that loop, an exact match wins even when a
+    later allowed value also contains the csv value.
+    """
+    key = value.lower()
+    if key in values:
+        return values[key]
+    for lower, attrval in reversed(values.items()):
+        if key in lower:
+            return attrval
+    return None
+
+
+def parse_metadata(met, attribute_index):
+    project_dict = {}
+    row = read_first_row(met, {col for col, _ in attribute_index.values() if col})
+
+    for attrname, (metadatafileCol, values) in attribute_index.items():
+        if (
+            metadatafileCol
+        ):  #### If corresponding column was mappable to the metadata.csv column
+            if (
+                metadatafileCol in row
+            ):  #### Not all metadata columns exist in all metadata.csv files
+                attrval = match_attribute(row[metadatafileCol], values)
+                if attrval is not None:
+                    project_dict[repr(attrname)] = repr(attrval)
+        elif attrname == "Access Tag":
+            project_dict[repr("Access Tag")] = "Internal"
+        else:
+            project_dict[attrname] = ""
+
+    return project_dict
+
+
+phase_times = {}
+phase_start = time.time()
+attribute_index = load_metadata_rules(
+    xmlfile, args.config, args.config_section, args.rules_cache
+)
+phase_times["rules"] = time.time() - phase_start
+
+
+#############################################################################################
+#### Migration journal
+#### Every successful upload is recorded in --journal, keyed on project, file path, size and
+#### sha256, with the metadata tags it was uploaded with. A file is uploaded again only when
+#### its content or its tags changed. Size and mtime are checked first so an unchanged file
+#### is not re-hashed; a file whose mtime moved is hashed before it is re-uploaded.
+#############################################################################################
+def open_journal(journal_path):
+    db = sqlite3.connect(journal_path, timeout=600)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS uploads (project TEXT, path TEXT, artifact TEXT, size INTEGER,
+                                            sha256 TEXT, mtime_ns INTEGER, tags TEXT,
+                                            uploaded_at TEXT, attempts INTEGER, seconds REAL,
+                                            PRIMARY KEY (project, path, artifact, size, sha256));
+        CREATE INDEX IF NOT EXISTS uploads_path ON uploads (project, path, artifact, uploaded_at);
+        """)
+    return db
+
+
+def journal_entry(journal, project, upload_path, artifact):
+    """Last recorded upload of upload_path (as artifact) for project, if any"""
+    if journal is None:
+        return None
+    row = journal.execute(
+        "SELECT size, sha256, mtime_ns, tags FROM uploads"
+        " WHERE project = ? AND path = ? AND artifact = ?"
+        " ORDER BY uploaded_at DESC LIMIT 1",
+        (project, os.path.abspath(upload_path), artifact or ""),
+    ).fetchone()
+    return dict(zip(("size", "sha256", "mtime_ns", "tags"), row)) if row else None
+
+
+def record_upload(journal, outcome):
+    with journal:
+        journal.execute(
+            "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                outcome["project"],
+                os.path.abspath(outcome["file"]),
+                outcome["artifact"] or "",
+                outcome["size"],
+                outcome["sha256"],
+                outcome["mtime_ns"],
+                outcome["tags"],
+                datetime.now().isoformat(timespec="seconds"),
+                outcome["attempts"],
+                outcome["seconds"],
+            ),
+        )
+
+
+def refresh_mtime(journal, outcome):
+    """Keep a touched but unchanged file from being hashed again on the next run"""
+    with journal:
+        journal.execute(
+            "UPDATE uploads SET mtime_ns = ?"
+            " WHERE project = ? AND path = ? AND artifact = ? AND size = ? AND sha256 = ?",
+            (
+                outcome["mtime_ns"],
+                outcome["project"],
+                os.path.abspath(outcome["file"]),
+                outcome["artifact"] or "",
+                outcome["size"],
+                outcome["sha256"],
+            ),
+        )
+
+
+def is_unchanged(entry, upload_path, tags):
+    """Same tags, size and mtime as the journaled upload (no hashing)"""
+    if entry is None or entry["tags"] != tags:
+        return False
+    try:
+        stat = os.stat(upload_path)
+    except OSError:
+        return False
+    return (stat.st_size, stat.st_mtime_ns) == (entry["size"], entry["mtime_ns"])
+
+
+def fingerprint_file(upload_path, entry, digest=True):
+    """
+    (size, mtime_ns, sha256), reusing the journaled sha256 while size and mtime match. Without
+    digest (no journal to record it in) the file is not read and sha256 is None.
+    """
+    stat = os.stat(upload_path)
+    if entry is not None and (stat.st_size, stat.st_mtime_ns) == (
+        entry["size"],
+        entry["mtime_ns"],
+    ):
+        return stat.st_size, stat.st_mtime_ns, entry["sha256"]
+    if not digest:
+        return stat.st_size, stat.st_mtime_ns, None
+
+    sha256 = hashlib.sha256()
+    with open(upload_path, "rb") as upload_obj:
+        for chunk in iter(lambda: upload_obj.read(1 << 20), b""):
+            sha256.update(chunk)
+    return stat.st_size, stat.st_mtime_ns, sha256.hexdigest()
+
+
+#############################################################################################
+#### Count matrix compression
+#### Count matrices are compressed pigz style: the file is read in COMPRESS_BLOCK sized
+#### blocks, each compressed on block_pool as its own gzip member, and the members are
+#### written in order. Concatenated members are a valid gzip file, and at most
+#### 2 x --compress_threads blocks per file are in memory at once. Compression runs inside
+#### the upload workers, so it overlaps with the uploads of other files.
+#############################################################################################
+COMPRESS_BLOCK = 4 << 20
+
+
+def compress_file(source, target, level, block_pool):
+    window = 2 * args.compress_threads
+    tmp = f"{target}.tmp"
+    with open(source, "rb") as source_obj, open(tmp, "wb") as target_obj:
+        members = deque()
+        for block in iter(lambda: source_obj.read(COMPRESS_BLOCK), b""):
+            members.append(block_pool.submit(gzip.compress, block, level, mtime=0))
+            if len(members) >= window:
+                target_obj.write(members.popleft().result())
+        while members:
+            target_obj.write(members.popleft().result())
+        if target_obj.tell() == 0:  #### an empty file still needs one gzip member
+            target_obj.write(gzip.compress(b"", level, mtime=0))
+    os.replace(tmp, target)
+
+
+#############################################################################################
+#### Sparse count matrices
+#### A tab separated count matrix (genes x samples, first column gene ids, one header line,
+#### '#' comment lines skipped) is converted to CSR in a .npz with the scipy.sparse.save_npz
+#### layout (data, indices, indptr, shape, format) plus genes and samples, so it loads with
+#### scipy.sparse.load_npz or plain numpy.load. Rows are parsed SPARSE_CHUNK_CELLS at a time
+#### and the non-zeros spilled to temporary files, which are then streamed into the .npz,
+#### so memory stays bounded whatever the size of the matrix.
+#############################################################################################
+SPARSE_CHUNK_CELLS = 1 << 20
+SPARSE_STREAM_ITEMS = 1 << 20
+
+
+def write_npy_member(npz, name, dtype, length, chunks):
+    """Stream a 1-d array into the .npz as name.npy, chunk by chunk"""
+    import numpy as np
+
+    with npz.open(f"{name}.npy", "w", force_zip64=True) as member:
+        np.lib.format.write_array_header_1_0(
+            member,
+            {
+                "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                "fortran_order": False,
+                "shape": (length,),
+            },
+        )
+        for chunk in chunks:
+            member.write(np.ascontiguousarray(chunk, dtype=dtype).tobytes())
+
+
+def read_spilled(path, dtype):
+    import numpy as np
+
+    with open(path, "rb") as spill_obj:
+        while True:
+            chunk = np.fromfile(spill_obj, dtype=dtype, count=SPARSE_STREAM_ITEMS)
+            if not chunk.size:
+                break
+            yield chunk
+
+
+def read_spilled_genes(path):
+    with open(path, "r", encoding="utf-8") as genes_obj:
+        while True:
+            chunk = list(itertools.islice(genes_obj, SPARSE_STREAM_ITEMS))
+            if not chunk:
+                break
+            yield [gene.rstrip("\n") for gene in chunk]
+
+
+def convert_sparse(source, target):
+    import numpy as np
+
+    spill = {
+        name: f"{target}.{name}.tmp" for name in ("data", "indices", "indptr", "genes")
+    }
+    try:
+        with open(source, "r", encoding="windows-1254") as source_obj, open(
+            spill["data"], "wb"
+        ) as data_obj, open(spill["indices"], "wb") as indices_obj, open(
+            spill["indptr"], "wb"
+        ) as indptr_obj, open(
+            spill["genes"], "w", encoding="utf-8"
+        ) as genes_obj:
+            lines = (line for line in source_obj if line.strip() and line[0] != "#")
+            header = next(lines, "").rstrip("\r\n").split("\t")
+            samples = None
+            nnz = n_genes = 0
+            integral, largest, gene_width = True, 0.0, 1
+            indptr_obj.write(np.zeros(1, dtype=np.int64).tobytes())
+
+            while True:
+                chunk_rows = SPARSE_CHUNK_CELLS // max(len(header), 1) + 1
+                rows = [
+                    line.rstrip("\r\n") for line in itertools.islice(lines, chunk_rows)
+                ]
+                if not rows:
+                    break
+                if samples is None:  #### headers without a label for the gene column
+                    samples = (
+                        header if rows[0].count("\t") == len(header) else header[1:]
+                    )
+                    if not samples:
+                        raise ValueError(f"{source}: no sample columns")
+                genes = [row.split("\t", 1)[0] for row in rows]
+                for gene, row in zip(genes, rows):
+                    if row.count("\t") != len(samples):
+                        raise ValueError(
+                            f"{source}: {gene} has {row.count(chr(9))} values for {len(samples)} samples"
+                        )
+
+                values = np.loadtxt(
+                    rows,
+                    delimiter="\t",
+                    usecols=range(1, len(samples) + 1),
+                    dtype=np.float64,
+                    comments=None,
+                    ndmin=2,
+                )
+                row_ids, indices = np.nonzero(values)
+                data = values[row_ids, indices]
+                if data.size:
+                    integral = integral and bool(np.all(data == np.trunc(data)))
+                    largest = max(largest, float(np.abs(data).max()))
+
+                data_obj.write(data.tobytes())
+                indices_obj.write(indices.astype(np.int32).tobytes())
+                counts = np.bincount(row_ids, minlength=len(rows))
+                indptr_obj.write((nnz + np.cumsum(counts)).astype(np.int64).tobytes())
+                genes_obj.write("\n".join(genes) + "\n")
+
+                nnz += data.size
+                n_genes += len(rows)
+                gene_width = max(gene_width, max(len(gene) for gene in genes))
+
+        samples = samples if samples is not None else header[1:]
+        data_dtype = np.int32 if integral and largest < 2**31 else np.float64
+        tmp = f"{target}.tmp"
+        with zipfile.ZipFile(
+            tmp, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True
+        ) as npz:
+            write_npy_member(
+                npz, "data", data_dtype, nnz, read_spilled(spill["data"], np.float64)
+            )
+            write_npy_member(
+                npz, "indices", np.int32, nnz, read_spilled(spill["indices"], np.int32)
+            )
+            write_npy_member(
+                npz,
+                "indptr",
+                np.int64,
+                n_genes + 1,
+                read_spilled(spill["indptr"], np.int64),
+            )
+            write_npy_member(
+                npz,
+                "genes",
+                f"<U{gene_width}",
+                n_genes,
+                read_spilled_genes(spill["genes"]),
+            )
+            write_npy_member(
+                npz,
+                "samples",
+                f"<U{max(map(len, samples), default=1)}",
+                len(samples),
+                [samples],
+            )
+            write_npy_member(npz, "shape", np.int64, 2, [(n_genes, len(samples))])
+            with npz.open("format.npy", "w") as member:
+                np.lib.format.write_array(member, np.array(b"csr"))
+        os.replace(tmp, target)
+    finally:
+        for path in spill.values():
+            if os.path.exists(path):
+                os.remove(path)
+
+
+#############################################################################################
+#### Staged uploads
+#### A count matrix is uploaded as is, gzip compressed (--compress) and/or converted to a sparse
+#### .npz (--sparse). Each form is a separate artifact with its own tags and journal entries.
+#############################################################################################
+ARTIFACT_SUFFIX = {"gzip": ".gz", "csr": ".npz"}
+ARTIFACT_TAGS = {
+    "gzip": {repr("Compression"): repr("gzip")},
+    "csr": {repr("Matrix Format"): repr("csr-npz")},
+}
+
+
+def stage_upload(project, upload_path, artifact):
+    """
+    Path to upload for upload_path, staging the artifact in --compress_dir first if one is set.
+    Every staged artifact gets a directory of its own, so count matrices of a project that share
+    a file name (e.g. several count.txt) keep their name in the datalake without overwriting or
+    removing each other while they are uploaded concurrently.
+    """
+    if artifact is None:
+        return upload_path
+    project_dir = os.path.join(args.compress_dir, project)
+    os.makedirs(project_dir, exist_ok=True)
+    stage_dir = tempfile.mkdtemp(dir=project_dir)
+    target = os.path.join(
+        stage_dir, os.path.basename(upload_path) + ARTIFACT_SUFFIX[artifact]
+    )
+    try:
+        if artifact == "csr":
+            convert_sparse(upload_path, target)
+        else:
+            compress_file(upload_path, target, args.compress_level, block_pool)
+    except BaseException:
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        raise
+    return target
+
+
+#############################################################################################
+#### Concurrent uploads
+#### Each file is uploaded by its own gdp process, at most --workers at a time. When the gdp
+#### client documents --folder-id for gdp data upload, uploads target the folder id of their
+#### project, so the files of every project share one pool: they are submitted as the masterfile
+#### is read and collected once all projects are submitted. Otherwise gdp data cd selects the
+#### project folder for all uploads, and the uploads of one project finish before the next.
+#### Failed uploads are retried with exponential backoff (plus jitter) and the outcome of
+#### every file is appended to --upload_log.
+#############################################################################################
+def upload_accepts_folder_id():
+    """Whether gdp data upload --help lists --folder-id"""
+    usage = subprocess.run(
+        f"{gdpclient} data upload --help",
+        shell=True,
+        capture_output=True,
+        encoding="utf-8",
+    )
+    return "--folder-id" in usage.stdout + usage.stderr
+
+
+def upload_command(project, folder_id, tags, upload_path):
+    """Upload into folder_id, or into the current folder of the gdp client if it is None"""
+    cmd = f"{gdpclient} data upload"
+    if folder_id:
+        cmd += f" --folder-id {folder_id}"
+    cmd += f" -m 'SCL Project Id'={project}"
+    for projectkey in tags:
+        if tags[projectkey]:
+            cmd += f" -m {projectkey}={tags[projectkey]}"
+    return f"{cmd} {upload_path}"
+
+
+def upload_file(project, folder_id, upload_path, tags, entry, artifact):
+    start = time.time()
+    outcome = {
+        "project": project,
+        "folder_id": folder_id,
+        "file": upload_path,
+        "artifact": artifact,
+        "tags": tags,
+        "attempts": 0,
+    }
+    try:
+        size, mtime_ns, sha256 = fingerprint_file(
+            upload_path, entry, digest=bool(args.journal)
+        )
+    except OSError as error:
+        outcome.update(status="failed", returncode=None, seconds=0, stderr=str(error))
+        return outcome
+    outcome.update(size=size, mtime_ns=mtime_ns, sha256=sha256)
+
+    if entry is not None and (entry["size"], entry["sha256"], entry["tags"]) == (
+        size,
+        sha256,
+        tags,
+    ):
+        outcome.update(status="skipped", returncode=0, seconds=0, stderr="")
+        return outcome
+
+    try:
+        staged_path = stage_upload(project, upload_path, artifact)
+    except (OSError, ValueError) as error:
+        outcome.update(status="failed", returncode=None, seconds=0, stderr=str(error))
+        return outcome
+    outcome.update(uploaded_size=os.path.getsize(staged_path))
+
+    cmd = upload_command(project, folder_id, json.loads(tags), staged_path)
+    while True:
+        outcome["attempts"] += 1
+        result = subprocess.run(cmd, shell=True, capture_output=True, encoding="utf-8")
+        if result.returncode == 0 or outcome["attempts"] > args.retries:
+            break
+        time.sleep(
+            args.backoff * 2 ** (outcome["attempts"] - 1) * random.uniform(0.5, 1.5)
+        )
+
+    outcome.update(
+        status="uploaded" if result.returncode == 0 else "failed",
+        returncode=result.returncode,
+        seconds=round(time.time() - start, 3),
+        stderr=result.stderr[-2000:],
+    )
+    if staged_path != upload_path:  #### the staging directory of the artifact
+        shutil.rmtree(os.path.dirname(staged_path), ignore_errors=True)
+    return outcome
+
+
+def collect_uploads(futures, log, journal):
+    """Wait for the upload_file() futures, logging and journaling every outcome as it completes"""
+    failed = 0
+    for future in as_completed(futures):
+        outcome = future.result()
+        log.write(json.dumps(outcome) + "\n")
+        log.flush()
+        print(
+            f"{outcome['status']}: {outcome['file']}"
+            f"{' as ' + outcome['artifact'] if outcome['artifact'] else ''} ({outcome['project']},"
+            f" {outcome['attempts']} attempt(s), {outcome['seconds']}s)"
+        )
+        if outcome["status"] == "uploaded" and journal is not None:
+            record_upload(journal, outcome)
+        elif outcome["status"] == "skipped":
+            refresh_mtime(journal, outcome)
+        elif outcome["status"] == "failed":
+            failed += 1
+            print(outcome["stderr"])
+    return failed
+
+
+#############################################################################################
+#### Datalake folder resolution
+#### Project folders under --parent_folder are listed once per run and kept in --folder_map.
+#### Mapped folders missing from the listing are resolved again, and a project costs more
+#### gdp calls only when its folder is missing from both the map and the listing. If the
+#### listing fails, missing folders are looked up with gdp data search instead.
+#############################################################################################
+FOLDER_LIST_CMD = '{gdp} data ls --folder-id {parent_folder} -o "id,name"'
+FOLDER_SEARCH_CMD = '{gdp} data search "Name = {name}" -o "id"'
+FOLDER_ID = re.compile(
+    r"folder-[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+)
+
+
+def load_folder_map(map_path, parent_folder):
+    if not os.path.exists(map_path):
+        return {}
+    with open(map_path, "r") as map_obj:
+        return json.load(map_obj).get(parent_folder, {})
+
+
+def save_folder_map(map_path, parent_folder, folder_map):
+    saved = {}
+    if os.path.exists(map_path):
+        with open(map_path, "r") as map_obj:
+            saved = json.load(map_obj)
+    saved[parent_folder] = folder_map
+
+    tmp = f"{map_path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as map_obj:
+        json.dump(saved, map_obj, indent=1, sort_keys=True)
+    os.replace(tmp, map_path)
+
+
+def list_project_folders(parent_folder):
+    """Folder name -> folder id for every folder directly under parent_folder, None if gdp cannot list it"""
+    listing = subprocess.run(
+        FOLDER_LIST_CMD.format(gdp=gdpclient, parent_folder=parent_folder),
+        shell=True,
+        capture_output=True,
+        encoding="utf-8",
+    )
+    if listing.returncode != 0:
+        print(f"Could not list folders under {parent_folder}: {listing.stderr}")
+        return None
+
+    folders = {}
+    for entry in listing.stdout.splitlines():
+        folder_id = FOLDER_ID.search(entry)
+        if folder_id:
+            name = entry[folder_id.end() :].strip(" \t,")
+            if name:
+                folders[name] = folder_id.group(0)
+    return folders
+
+
+def search_project_folder(project):
+    """Folder id of the folder named project, None if there is none"""
+    found = subprocess.run(
+        FOLDER_SEARCH_CMD.format(gdp=gdpclient, name=project),
+        shell=True,
+        capture_output=True,
+        encoding="utf-8",
+    )
+    folder_id = FOLDER_ID.search(found.stdout) if found.returncode == 0 else None
+    return folder_id.group(0) if folder_id else None
+
+
+def create_project_folder(project, parent_folder):
+    """
+    Folder id of a new folder named project. A folder that already exists is looked up
+    instead, and None is returned if gdp cannot tell its id.
+    """
+    created = subprocess.run(
+        f"{gdpclient} data mkdir --folder-id {parent_folder} {project}",
+        shell=True,
+        capture_output=True,
+        encoding="utf-8",
+    )
+    if created.returncode != 0 and "already exists" not in (
+        created.stdout + created.stderr
+    ):
+        raise RuntimeError(f"Could not create folder {project}: {created.stderr}")
+    folder_id = FOLDER_ID.search(created.stdout) if created.returncode == 0 else None
+    folder_id = folder_id.group(0) if folder_id else search_project_folder(project)
+    if folder_id is None:
+        print(f"Could not find the folder id of {project}; its files are not uploaded")
+    return folder_id
+
+
+def resolve_project_folders(projects, parent_folder, map_path):
+    """Project -> folder id (None if unresolved), searching for and creating folders only for unknown projects"""
+    folder_map = load_folder_map(map_path, parent_folder)
+    listing = list_project_folders(parent_folder)
+    #### Folders removed from the datalake since they were mapped are resolved again
+    if listing is not None:
+        folder_map = {
+            project: folder_id
+            for project, folder_id in folder_map.items()
+            if listing.get(project) == folder_id
+        }
+
+    for project in projects:
+        if project in folder_map:
+            continue
+        if listing is not None:
+            folder_id = listing.get(project)
+        else:
+            folder_id = search_project_folder(project)
+        folder_map[project] = folder_id or create_project_folder(project, parent_folder)
+    save_folder_map(
+        map_path,
+        parent_folder,
+        {project: folder_id for project, folder_id in folder_map.items() if folder_id},
+    )
+    return folder_map
+
+
+def enter_project_folder(project, parent_folder):
+    """cd into the project folder, for gdp clients without gdp data upload --folder-id"""
+    cdfolder = f"{gdpclient} data cd --folder-id {parent_folder} {project}"
+    return subprocess.run(cdfolder, shell=True).returncode == 0
+
+
+#############################################################################################
+#### Read info from Ruidong's project masterfile
+#### Expected format: Project,Data Type,Count Matrix,Sample Metadata
+#### Additional implementation - if folder in datalake already exists, do not create another
+#############################################################################################
+with open(masterfile, "r") as master:
+    entries = [
+        line.strip().split(",")
+        for line in master.readlines()
+        if re.search("^SCL", line)
+    ]
+
+phase_start = time.time()
+subprocess.run(f"{gdpclient} clear", shell=True)
+folder_map = resolve_project_folders(
+    [entry[0] for entry in entries], parent_folder, args.folder_map
+)
+folder_uploads = upload_accepts_folder_id()
+if not folder_uploads:
+    print(
+        "gdp data upload has no --folder-id; uploading one project at a time after gdp data cd"
+    )
+phase_times["folders"] = time.time() - phase_start
+
+#############################################################################################
+#### Hard-coded metadata tags for count matrices that come without a metadata.csv
+#############################################################################################
+COUNT_MATRIX_TAGS = {
+    '"Access Tag"': '"Internal"',
+    '"Analyte"': '"RNA"',
+    '"Sequencing Application"': '"mRNA-seq"',
+    '"Sequencing Platform"': '"Illumina"',
+    '"Data Source"': '"Gilead Sequencing Core"',
+    '"Analysis Type"': '"Bulk RNASeq"',
+}
+
+journal = open_journal(args.journal) if args.journal else None
+count_artifacts = []
+if args.sparse != "instead":
+    count_artifacts.append(None if args.compress == "none" else args.compress)
+if args.sparse != "none":
+    count_artifacts.append("csr")
+block_pool = ThreadPoolExecutor(max_workers=args.compress_threads)
+
+phase_start = time.time()
+failed_uploads = 0
+futures = []
+with open(args.upload_log, "a") as upload_log, ThreadPoolExecutor(
+    max_workers=args.workers
+) as pool:
+    for project, dattype, countmat, metadat in entries:
+        countfiles = countmat.split("\t")
+        metadatfiles = metadat.split("\t")
+
+        uploads = []
+
+        if metadat:
+            for met in metadatfiles:
+                project_dict = parse_metadata(met, attribute_index)
+                uploads.append((project, met, project_dict, None))
+
+            ### If the metadata.csv file is available, extract the tags for the count.txt from the metadata.csv
+            if countmat:
+                for count in countfiles:
+                    for artifact in count_artifacts:
+                        uploads.append((project, count, project_dict, artifact))
+
+        elif (
+            countmat
+        ):  ### If only count matrix files are available, upload them with hard-coded metadata tags for now
+            for count in countfiles:
+                for artifact in count_artifacts:
+                    uploads.append((project, count, COUNT_MATRIX_TAGS, artifact))
+        else:
+            print(f"No Files to upload for {project}")
+
+        ### Files already in the journal with the same size, mtime and tags do not need the project folder
+        pending = []
+        for project, upload_path, tags, artifact in uploads:
+            tags = json.dumps(
+                dict(tags, **ARTIFACT_TAGS.get(artifact, {})), sort_keys=True
+            )
+            entry = (
+                None
+                if args.force
+                else journal_entry(journal, project, upload_path, artifact)
+            )
+            if is_unchanged(entry, upload_path, tags):
+                print(
+                    f"skipped: {upload_path}{' as ' + artifact if artifact else ''}"
+                    f" ({project}, unchanged since last upload)"
+                )
+            else:
+                pending.append(
+                    (
+                        project,
+                        folder_map[project] if folder_uploads else None,
+                        upload_path,
+                        tags,
+                        entry,
+                        artifact,
+                    )
+                )
+
+        if not pending:
+            continue
+        if folder_map[project] is None:
+            print(f"failed: {len(pending)} file(s) of {project}, no datalake folder")
+            failed_uploads += len(pending)
+        elif folder_uploads:
+            futures.extend(pool.submit(upload_file, *upload) for upload in pending)
+        elif enter_project_folder(project, parent_folder):
+            failed_uploads += collect_uploads(
+                [pool.submit(upload_file, *upload) for upload in pending],
+                upload_log,
+                journal,
+            )
+        else:
+            print(f"failed: {len(pending)} file(s) of {project}, gdp data cd failed")
+            failed_uploads += len(pending)
+
+    failed_uploads += collect_uploads(futures, upload_log, journal)
+
+block_pool.shutdown()
+phase_times["uploads"] = time.time() - phase_start
+
+if args.timings:
+    with open(args.timings, "w") as timings_obj:
+        json.dump(phase_times, timings_obj, indent=1)
+
+if failed_uploads:
+    print(f"{failed_uploads} file(s) failed to upload; see {args.upload_log}")
+    raise SystemExit(1)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+#####################################################################################
+##### Local stand-in for the gdp client, for benchmarking and testing the data migration
+##### tool without a Genedata server. Point the migration at it with --gdp or $GDP_CLIENT.
+#####
+##### Emulates: gdp clear
+#####           gdp data search "Name = <name>" -o "id"
+#####           gdp data ls --folder-id <parent> -o "id,name"
+#####           gdp data mkdir --folder-id <parent> <name>
+#####           gdp data cd --folder-id <parent> <name>
+#####           gdp data upload -m <key>=<value> ... <file>
+#####
+##### Behaviour is set through the environment, as the migration tool owns the command line:
+#####   FAKE_GDP_STATE          folders, current folder and uploads.jsonl (default ./.fake_gdp)
+#####   FAKE_GDP_LATENCY        seconds added to every call (default 0)
+#####   FAKE_GDP_FAILURE_RATE   probability that a call fails (default 0)
+#####   FAKE_GDP_<CMD>_LATENCY, FAKE_GDP_<CMD>_FAILURE_RATE
+#####                           per command overrides, e.g. FAKE_GDP_UPLOAD_FAILURE_RATE=0.05
+#####   FAKE_GDP_UPLOAD_MBPS    simulated upload bandwidth in MB/s (default 0, unlimited)
+#####   FAKE_GDP_UPLOAD_FOLDER_ID
+#####                           set to 1 to also accept gdp data upload --folder-id <folder>,
+#####                           which the verified client does not document (default off)
+#####################################################################################
+
+import os
+import sys
+import json
+import time
+import uuid
+import fcntl
+import random
+import argparse
+from contextlib import contextmanager
+
+STATE = os.environ.get("FAKE_GDP_STATE", ".fake_gdp")
+
+
+def setting(name, command, default=0.0):
+    value = os.environ.get(f"FAKE_GDP_{command.upper()}_{name}")
+    if value is None:
+        value = os.environ.get(f"FAKE_GDP_{name}", default)
+    return float(value)
+
+
+@contextmanager
+def locked_state():
+    """Folders and current folder, saved on exit; calls from concurrent uploads are serialized"""
+    os.makedirs(STATE, exist_ok=True)
+    with open(os.path.join(STATE, "lock"), "w") as lock_obj:
+        fcntl.flock(lock_obj, fcntl.LOCK_EX)
+        state_path = os.path.join(STATE, "state.json")
+        state = {"folders": {}, "cwd": None}
+        if os.path.exists(state_path):
+            with open(state_path, "r") as state_obj:
+                state = json.load(state_obj)
+        yield state
+        with open(f"{state_path}.tmp", "w") as state_obj:
+            json.dump(state, state_obj)
+        os.replace(f"{state_path}.tmp", state_path)
+
+
+def find_folder(state, name, parent=None):
+    for folder_id, folder in state["folders"].items():
+        if folder["name"] == name and parent in (None, folder["parent"]):
+            return folder_id
+    return None
+
+
+def clear(args):
+    with locked_state() as state:
+        state["cwd"] = None
+
+
+def search(args):
+    name = args.query.split("=", 1)[-1].strip()
+    with locked_state() as state:
+        folder_id = find_folder(state, name)
+    if folder_id is None:
+        sys.exit(f"No results for {args.query}")
+    print(folder_id)
+
+
+def ls(args):
+    with locked_state() as state:
+        for folder_id, folder in sorted(state["folders"].items()):
+            if folder["parent"] == args.folder_id:
+                print(f"{folder_id}\t{folder['name']}")
+
+
+def mkdir(args):
+    with locked_state() as state:
+        if find_folder(state, args.name, args.folder_id):
+            sys.exit(f"Folder {args.name} already exists")
+        folder_id = f"folder-{uuid.uuid4()}"
+        state["folders"][folder_id] = {"name": args.name, "parent": args.folder_id}
+    print(f"Created folder {args.name} {folder_id}")
+
+
+def cd(args):
+    with locked_state() as state:
+        folder_id = find_folder(state, args.name, args.folder_id)
+        if folder_id is None:
+            sys.exit(f"No folder {args.name} in {args.folder_id}")
+        state["cwd"] = folder_id
+
+
+def upload(args):
+    with locked_state() as state:
+        folder_id = getattr(args, "folder_id", None) or state["cwd"]
+        if folder_id is None:
+            sys.exit("No current folder; run gdp data cd first")
+        if folder_id not in state["folders"]:
+            sys.exit(f"No folder {folder_id}")
+
+    size = 0
+    with open(args.file, "rb") as upload_obj:
+        for chunk in iter(lambda: upload_obj.read(1 << 20), b""):
+            size += len(chunk)
+    mbps = setting("MBPS", "upload")
+    if mbps:
+        time.sleep(size / (mbps * 1e6))
+
+    record = {"folder": folder_id, "file": args.file, "size": size, "tags": args.m}
+    with open(os.path.join(STATE, "uploads.jsonl"), "a") as uploads_obj:
+        uploads_obj.write(json.dumps(record) + "\n")
+    print(f"Uploaded {args.file}")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="gdp")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("clear").set_defaults(func=clear)
+    data = commands.add_parser("data").add_subparsers(dest="command", required=True)
+
+    search_parser = data.add_parser("search")
+    search_parser.add_argument("query")
+    search_parser.add_argument("-o")
+    search_parser.set_defaults(func=search)
+
+    ls_parser = data.add_parser("ls")
+    ls_parser.add_argument("--folder-id", required=True)
+    ls_parser.add_argument("-o")
+    ls_parser.set_defaults(func=ls)
+
+    for name, func in (("mkdir", mkdir), ("cd", cd)):
+        folder_parser = data.add_parser(name)
+        folder_parser.add_argument("--folder-id", required=True)
+        folder_parser.add_argument("name")
+        folder_parser.set_defaults(func=func)
+
+    upload_parser = data.add_parser("upload")
+    if os.environ.get("FAKE_GDP_UPLOAD_FOLDER_ID") == "1":
+        upload_parser.add_argument("--folder-id")
+    upload_parser.add_argument("-m", action="append", default=[])
+    upload_parser.add_argument("file")
+    upload_parser.set_defaults(func=upload)
+
+    args = parser.parse_args(argv)
+
+    time.sleep(setting("LATENCY", args.command))
+    if random.random() < setting("FAILURE_RATE", args.command):
+        sys.exit(f"gdp {args.command}: simulated failure")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])